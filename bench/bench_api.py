@@ -0,0 +1,311 @@
+"""Benchmark suite driving the sdap app in-process.
+
+Usage: python bench/bench_api.py [--requests N] [--rows N] [--only NAME ...]
+                                 [--cache] [--fake-redis] [--save-baseline FILE]
+                                 [--baseline FILE] [--tolerance PCT]
+
+Requests go through falcon's test client straight into `sdap.app.app`, so the
+figures cover the middlewares and handlers without uwsgi or nginx. The app
+runs against the MySQL server and redis of $SDAP_CONFIG (default
+/etc/sdap/config.yml); use a local,
+disposable MySQL (e.g. `docker run -e MYSQL_ROOT_PASSWORD=... mysql:5.7`), as
+the suite creates and drops a table, an app and an admin account of its own.
+With --fake-redis, redis is replaced by fakeredis (which needs lupa for the
+Lua scripts of the query cache).
+
+The query cache is on with --cache and off otherwise, whatever `redis.enabled`
+says. The `*_hit` scenarios measure cached reads, so they only run with --cache.
+
+A stand-in database such as SQLite is out of scope: the code under test relies
+on MySQL itself (the information_schema catalog, SHOW GRANTS, SHOW TABLE
+STATUS and EXPLAIN for counts, ON DUPLICATE KEY UPDATE, per-app MySQL users),
+so figures taken without it would not measure the service. For the same
+reason no baseline of this suite is kept in the repository, as its figures
+depend on the MySQL host; record one on the machine the comparison runs on.
+bench/baseline_json.json is the committed baseline of bench_json.py, which
+needs no database.
+
+The time to import the app and the latency of its first request are reported
+first. Each scenario reports throughput, p50/p99 latency and the peak RSS of the
+process so far. --save-baseline writes the results to a file; --baseline
+compares against one and exits with status 1 if a scenario's p50 regressed by
+more than --tolerance percent. A baseline records whether the cache was on, and
+is only compared against a run with the same setting.
+"""
+import sys
+import json
+import platform
+import random
+import argparse
+import resource
+
+from timeit import default_timer
+from datetime import datetime, timedelta
+
+TABLE = 'bench_rows'
+APP = 'bench'
+ADMIN = '__bench_admin'
+
+_SCHEMA = """CREATE TABLE {} (
+    id INT AUTO_INCREMENT PRIMARY KEY,
+    name VARCHAR(64) NOT NULL,
+    email VARCHAR(128) NOT NULL,
+    score INT NOT NULL,
+    balance DECIMAL(12, 2) NOT NULL,
+    created DATETIME NOT NULL,
+    note TEXT NULL,
+    KEY score (score)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8"""
+
+
+def _row(i):
+    return {
+        'name': 'user {}'.format(i),
+        'email': 'user{}@example.com'.format(i),
+        'score': i % 100,
+        'balance': '{}.{:02d}'.format(i * 7, i % 100),
+        'created': (datetime(2017, 5, 1) + timedelta(minutes=i)).strftime('%Y-%m-%d %H:%M:%S'),
+        'note': None if i % 3 else 'note {}'.format(i),
+    }
+
+
+class Fixture(object):
+    """Creates the bench table, app and admin account, and removes them again."""
+    def __init__(self, client, rows):
+        from sdap.db import LOCAL_CONN
+        from sdap.config import shared_db_name
+        self.client = client
+        self.rows = rows
+        self.conn = LOCAL_CONN
+        self.db = shared_db_name()
+        self.admin_key = None
+        self.key = None
+
+    def _admin(self, method, path, doc=None):
+        result = self.client.simulate_request(method, path, headers=_headers(self.admin_key, method == 'POST'),
+                                              body=json.dumps(doc) if doc is not None else None)
+        _check(result, "{} {}".format(method, path))
+        return json.loads(result.text) if result.text else None
+
+    def setup(self):
+        from sdap.user import User
+        self.teardown()
+        with self.conn.new_session() as session:
+            admin = User.new(app=ADMIN, desc="benchmark admin", is_admin=True)
+            self.admin_key = admin.issue_key()
+            session.add(admin)
+        engine = self.conn.connect()
+        try:
+            engine.execute(_SCHEMA.format('`{}`.`{}`'.format(self.db, TABLE)))
+            columns = sorted(_row(0))
+            statement = "INSERT INTO `{}`.`{}` ({}) VALUES ({})".format(
+                self.db, TABLE, ','.join(columns), ','.join(['%s'] * len(columns)))
+            for start in range(0, self.rows, 1000):
+                engine.execute(statement, [tuple(_row(i)[c] for c in columns)
+                                           for i in range(start, min(start + 1000, self.rows))])
+        finally:
+            engine.close()
+        self._admin('POST', '/catalog')
+        self._admin('POST', '/register', {'app': APP, 'description': 'benchmark app'})
+        self._admin('POST', '/privilege/{}'.format(APP), {'priv': [
+            {'table': TABLE, 'perms': [{'column': '_all_', 'access': ['select', 'insert', 'update', 'delete']}]}]})
+        self.key = self._admin('POST', '/key/{}'.format(APP))['key']
+
+    def teardown(self):
+        from sdap.user import User
+        engine = self.conn.connect()
+        try:
+            engine.execute("DROP TABLE IF EXISTS `{}`.`{}`".format(self.db, TABLE))
+            with self.conn.new_session() as session:
+                for app in (APP, ADMIN):
+                    user = session.query(User).filter(User.app == app).first()
+                    if user is None:
+                        continue
+                    if not user.is_admin:
+                        for host in ('localhost', '%'):
+                            engine.execute("DROP USER '{}'@'{}'".format(user.user, host))
+                    session.delete(user)
+        finally:
+            engine.close()
+
+
+def _headers(key, json_body=False):
+    headers = {'Authorization': key}
+    if json_body:
+        headers['Content-Type'] = 'application/json'
+    return headers
+
+def _check(result, what):
+    if not result.status.startswith('2'):
+        raise SystemExit("{} failed: {} {}".format(what, result.status, result.text[:500]))
+
+
+def scenarios(rows):
+    """Returns [(name, requests per run relative to --requests, prepare, request)].
+
+    `prepare` runs untimed before each request, `request` returns
+    (method, path, query string, body).
+    """
+    from sdap import cache
+    page = 'limit=100&total=false'
+    ids = list(range(1, rows + 1))
+    inserted = [rows]
+
+    def nothing():
+        pass
+
+    def cold_auth():
+        cache.invalidate_auth(APP)
+
+    def cold_table():
+        cache.invalidate_table(TABLE)
+
+    def row():
+        return 'GET', '/data/{}/{}'.format(TABLE, random.choice(ids)), '', None
+
+    def bulk():
+        inserted[0] += 100
+        columns = sorted(_row(0))
+        values = [[_row(i)[c] for c in columns] for i in range(inserted[0] - 100, inserted[0])]
+        return 'POST', '/data/{}'.format(TABLE), '', json.dumps({'columns': columns, 'values': values})
+
+    return [
+        ('auth_cold', 1, cold_auth, lambda: ('GET', '/data/{}/1'.format(TABLE), '', None)),
+        ('auth_warm', 1, nothing, lambda: ('GET', '/data/{}/1'.format(TABLE), '', None)),
+        ('row_read', 1, nothing, row),
+        ('row_read_miss', 1, cold_table, row),
+        ('page_read_hit', 1, nothing, lambda: ('GET', '/data/{}'.format(TABLE), page, None)),
+        ('page_read_miss', 1, cold_table, lambda: ('GET', '/data/{}'.format(TABLE), page, None)),
+        ('page_read_start', 1, cold_table, lambda: ('GET', '/data/{}'.format(TABLE),
+                                                    '{}&start={}'.format(page, random.choice(ids)), None)),
+        ('full_read_miss', 0.05, cold_table, lambda: ('GET', '/data/{}'.format(TABLE), '', None)),
+        ('full_read_hit', 0.25, nothing, lambda: ('GET', '/data/{}'.format(TABLE), '', None)),
+        ('count_hit', 1, nothing, lambda: ('GET', '/count/{}'.format(TABLE), '', None)),
+        ('count_miss', 1, cold_table, lambda: ('GET', '/count/{}'.format(TABLE), '', None)),
+        ('count_estimate', 1, nothing, lambda: ('GET', '/count/{}'.format(TABLE), 'estimate=1', None)),
+        ('bulk_insert_100', 0.25, nothing, bulk),
+    ]
+
+
+def _percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+def _peak_rss_mb():
+    # kilobytes on Linux, bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024.0 * 1024.0) if sys.platform == 'darwin' else peak / 1024.0
+
+def run(client, key, name, count, prepare, request):
+    latencies = []
+    spent = 0.0
+    for _ in range(count):
+        prepare()
+        method, path, query, body = request()
+        started = default_timer()
+        result = client.simulate_request(method, path, query_string=query, body=body,
+                                         headers=_headers(key, body is not None))
+        elapsed = default_timer() - started
+        _check(result, name)
+        latencies.append(elapsed)
+        spent += elapsed
+    latencies.sort()
+    return {
+        'requests': count,
+        'throughput': count / spent,
+        'p50_ms': _percentile(latencies, 0.5) * 1000,
+        'p99_ms': _percentile(latencies, 0.99) * 1000,
+        'peak_rss_mb': _peak_rss_mb(),
+    }
+
+
+def _cached(name):
+    return name.endswith('_hit')
+
+
+def compare(results, baseline, tolerance):
+    """Prints the changes against a baseline; returns the regressed scenarios."""
+    regressed = []
+    print("\n{:<18} {:>10} {:>10} {:>10}".format('vs baseline', 'req/s', 'p50', 'p99'))
+    for name, figures in results.items():
+        if name not in baseline:
+            continue
+        base = baseline[name]
+        change = lambda field: 100.0 * (figures[field] - base[field]) / base[field]
+        print("{:<18} {:>+9.1f}% {:>+9.1f}% {:>+9.1f}%".format(
+            name, change('throughput'), change('p50_ms'), change('p99_ms')))
+        if change('p50_ms') > tolerance:
+            regressed.append(name)
+    return regressed
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--requests', type=int, default=500, help="requests per scenario (before scaling)")
+    parser.add_argument('--rows', type=int, default=10000, help="rows of the bench table")
+    parser.add_argument('--only', nargs='*', help="scenarios to run")
+    parser.add_argument('--cache', action='store_true', help="turn the query cache on")
+    parser.add_argument('--fake-redis', action='store_true', help="replace redis by fakeredis")
+    parser.add_argument('--save-baseline', metavar='FILE')
+    parser.add_argument('--baseline', metavar='FILE')
+    parser.add_argument('--tolerance', type=float, default=10.0, help="allowed p50 regression, in percent")
+    args = parser.parse_args(argv)
+    refused = [name for name in args.only or () if _cached(name)] if not args.cache else []
+    if refused:
+        parser.error("{} measure cached reads, run with --cache".format(', '.join(refused)))
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get('_run', {}).get('cache', args.cache) != args.cache:
+            parser.error("{} was recorded with the query cache {}".format(
+                args.baseline, 'on' if baseline['_run']['cache'] else 'off'))
+
+    from sdap import config
+    config.CONF['redis']['enabled'] = args.cache
+    if args.fake_redis:
+        import redis
+        import fakeredis
+        redis.StrictRedis = fakeredis.FakeStrictRedis
+    random.seed(0)
+
+    from falcon import testing
+    started = default_timer()
+    from sdap.app import app
+    imported = default_timer() - started
+    client = testing.TestClient(app)
+    fixture = Fixture(client, args.rows)
+    fixture.setup()
+    results = {}
+    try:
+        # the app's first request: its engine, authentication and cached queries are cold
+        started = default_timer()
+        _check(client.simulate_get('/count/{}'.format(TABLE), headers=_headers(fixture.key)), 'first request')
+        first = default_timer() - started
+        print("import sdap.app: {:.1f} ms, first request: {:.1f} ms\n".format(imported * 1000, first * 1000))
+        print("{:<18} {:>8} {:>10} {:>10} {:>10} {:>10}".format(
+            'scenario', 'requests', 'req/s', 'p50 ms', 'p99 ms', 'rss MB'))
+        for name, scale, prepare, request in scenarios(args.rows):
+            if (args.only and name not in args.only) or (_cached(name) and not args.cache):
+                continue
+            figures = run(client, fixture.key, name, max(1, int(args.requests * scale)), prepare, request)
+            results[name] = figures
+            print("{:<18} {requests:>8} {throughput:>10.1f} {p50_ms:>10.2f} {p99_ms:>10.2f} {peak_rss_mb:>10.1f}".format(
+                name, **figures))
+    finally:
+        fixture.teardown()
+
+    if args.save_baseline:
+        # the options are recorded along, figures being meaningless without them
+        saved = dict(results, _run={'python': platform.python_version(), 'machine': platform.machine(),
+                                    'rows': args.rows, 'requests': args.requests, 'cache': args.cache})
+        with open(args.save_baseline, 'w') as f:
+            json.dump(saved, f, indent=2, sort_keys=True, separators=(',', ': '))
+    if args.baseline:
+        regressed = compare(results, baseline, args.tolerance)
+        if regressed:
+            print("\nregressed beyond {}%: {}".format(args.tolerance, ', '.join(regressed)))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
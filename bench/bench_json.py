@@ -0,0 +1,113 @@
+"""Micro-benchmark of the JSON encoders on rows shaped like `_select` output.
+
+Usage: python bench/bench_json.py [--rows N] [--repeat N]
+                                  [--save-baseline FILE] [--baseline FILE] [--tolerance PCT]
+
+Encodes a page of wide rows (ints, strings, DATETIME, DATE, TIME, DECIMAL,
+NULL) as a JSON and a columnar response with every installed encoder, and
+with stdlib json called the way it was before encoders became pluggable.
+
+It needs neither MySQL nor redis, so its baseline is kept in the repository:
+bench/baseline_json.json, recorded with the default options on python 2.7.
+Figures depend on the machine, so compare against a baseline saved on the
+same host (--save-baseline) before trusting a regression; --baseline exits
+with status 1 if an encoder's rows/s dropped by more than --tolerance percent.
+"""
+import sys
+import json
+import timeit
+import platform
+import argparse
+
+from decimal import Decimal
+from datetime import datetime, date, timedelta
+
+from sdap import formats
+
+
+def _previous(obj):
+    # stdlib json as called before encoders became pluggable
+    return json.dumps(obj, default=formats._serialize)
+
+
+def make_rows(count):
+    columns = ['id', 'name', 'email', 'score', 'balance', 'created', 'birthday', 'slot', 'note']
+    start = datetime(2017, 5, 1, 8, 30)
+    rows = []
+    for i in range(count):
+        rows.append((
+            i,
+            u'user {}'.format(i),
+            u'user{}@example.com'.format(i),
+            i % 100,
+            Decimal('{}.{:02d}'.format(i * 7, i % 100)),
+            start + timedelta(minutes=i),
+            date(1980 + i % 30, 1 + i % 12, 1 + i % 28),
+            timedelta(hours=i % 24, minutes=i % 60),
+            None if i % 3 else u'note',
+        ))
+    return columns, rows
+
+
+def compare(results, baseline, tolerance):
+    """Prints the changes against a baseline; returns the regressed encoders."""
+    regressed = []
+    print("\n{:<16} {:>12} {:>12}".format('vs baseline', 'json', 'columnar'))
+    for name, figures in sorted(results.items()):
+        if name not in baseline:
+            continue
+        base = baseline[name]
+        changes = [100.0 * (figures[field] - base[field]) / base[field] for field in ('json', 'columnar')]
+        print("{:<16} {:>+11.1f}% {:>+11.1f}%".format(name, *changes))
+        if min(changes) < -tolerance:
+            regressed.append(name)
+    return regressed
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--rows', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--save-baseline', metavar='FILE')
+    parser.add_argument('--baseline', metavar='FILE')
+    parser.add_argument('--tolerance', type=float, default=10.0, help="allowed rows/s regression, in percent")
+    args = parser.parse_args(argv)
+
+    columns, rows = make_rows(args.rows)
+    encoders = [('json (previous)', _previous)]
+    for name in ('json', 'ujson', 'orjson'):
+        available, dumps = formats.ENCODERS[name]
+        if available():
+            encoders.append((name, dumps))
+
+    print("{} rows x {} columns, best of {} runs; selected encoder: {}".format(
+        len(rows), len(columns), args.repeat, formats.encoder()[0]))
+    print("{:<16} {:>12} {:>12}".format('encoder', 'json rows/s', 'columnar rows/s'))
+    results = {}
+    for name, dumps in encoders:
+        rates = []
+        for fmt in (formats.JSON, formats.COLUMNAR):
+            def run():
+                return dumps({'result': 'ok', 'data': formats.shape_rows(fmt, columns, rows)})
+            best = min(timeit.repeat(run, number=1, repeat=args.repeat))
+            rates.append(len(rows) / best)
+        results[name] = {'json': int(rates[0]), 'columnar': int(rates[1])}
+        print("{:<16} {:>12.0f} {:>12.0f}".format(name, *rates))
+
+    if args.save_baseline:
+        # the interpreter and options are recorded along, figures being meaningless without them
+        saved = dict(results, _run={'python': platform.python_version(), 'machine': platform.machine(),
+                                    'rows': len(rows), 'repeat': args.repeat})
+        with open(args.save_baseline, 'w') as f:
+            json.dump(saved, f, indent=2, sort_keys=True, separators=(',', ': '))
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressed = compare(results, json.load(f), args.tolerance)
+        if regressed:
+            print("\nregressed beyond {}%: {}".format(args.tolerance, ', '.join(regressed)))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
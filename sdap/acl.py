@@ -0,0 +1,87 @@
+import re
+
+
+PRIVILEGES = ('SELECT', 'INSERT', 'UPDATE', 'DELETE')
+
+_GRANT = re.compile(r"^GRANT (?P<privs>.+?) ON (?P<object>\S+) TO ")
+_QUOTED = re.compile(r"`((?:[^`]|``)*)`")
+
+
+def _split_privileges(privs):
+    """Splits `SELECT (`a`, `b`), INSERT` at the commas outside parentheses."""
+    parts, depth, current = [], 0, ''
+    for ch in privs:
+        if ch == '(':
+            depth += 1
+        elif ch == ')':
+            depth -= 1
+        if ch == ',' and depth == 0:
+            parts.append(current.strip())
+            current = ''
+        else:
+            current += ch
+    parts.append(current.strip())
+    return parts
+
+
+def _unquote(name):
+    return name[1:-1].replace('``', '`') if name.startswith('`') else name
+
+
+def parse_grants(rows, db):
+    """Parses the output of SHOW GRANTS into a privilege map.
+
+    Only grants on database `db` (or on all databases) are kept.
+
+    Args:
+        rows(list): result rows of SHOW GRANTS.
+        db(str):    the shared database.
+
+    Returns:
+        {table: {privilege: columns}}, where table is '*' for database-wide grants
+        and columns is None if the privilege applies to all columns, a set otherwise.
+    """
+    grants = {}
+    for row in rows:
+        match = _GRANT.match(row[0])
+        if not match:
+            continue
+        schema, _, table = match.group('object').partition('.')
+        if _unquote(schema) not in (db, '*'):
+            continue
+        table = _unquote(table)
+        table_grants = grants.setdefault(table, {})
+        for priv in _split_privileges(match.group('privs')):
+            name, _, columns = priv.partition('(')
+            name = name.strip()
+            if name == 'ALL PRIVILEGES' or name == 'ALL':
+                for p in PRIVILEGES:
+                    table_grants[p] = None
+                continue
+            if name not in PRIVILEGES:
+                continue
+            if not columns:
+                table_grants[name] = None
+            elif table_grants.get(name, set()) is not None:
+                table_grants[name] = table_grants.get(name, set()) | set(_QUOTED.findall(columns))
+    return grants
+
+
+def allowed(grants, table, privilege, columns=None):
+    """Checks a privilege map the way MySQL checks grants.
+
+    Args:
+        grants(dict):    privilege map obtained by `parse_grants`.
+        table(str):      table accessed.
+        privilege(str):  one of `PRIVILEGES`.
+        columns(list):   columns accessed, None if the privilege is table-wide.
+    """
+    granted = set()
+    for scope in (table, '*'):
+        if privilege not in grants.get(scope, {}):
+            continue
+        scope_columns = grants[scope][privilege]
+        if scope_columns is None:
+            return True
+        granted |= scope_columns
+    return columns is not None and bool(granted) and set(columns) <= granted
@@ -1,13 +1,25 @@
-from sdap.api.mysql import RDBTableAccess, RDBRowAccess, RDBTableCount
+from sdap.api.mysql import RDBTableAccess, RDBRowAccess, RDBTableCount, RDBBatch, RDBTableAggregate
 from sdap.api.register import Register
 from sdap.api.privilege import Privilege
 from sdap.api.key_mgmt import KeyManagement
+from sdap.api.cache_mgmt import CacheManagement
+from sdap.api.pool_mgmt import PoolManagement
+from sdap.api.catalog_mgmt import CatalogManagement
+from sdap.api.metrics_mgmt import MetricsManagement
+from sdap.api.profile_mgmt import ProfileManagement
 
 mysql_table = RDBTableAccess()
 mysql_row = RDBRowAccess()
 mysql_count = RDBTableCount()
+mysql_batch = RDBBatch()
+mysql_aggregate = RDBTableAggregate()
 register = Register()
 privilege = Privilege()
 key_mgmt = KeyManagement()
+cache_mgmt = CacheManagement()
+pool_mgmt = PoolManagement()
+catalog_mgmt = CatalogManagement()
+metrics_mgmt = MetricsManagement()
+profile_mgmt = ProfileManagement()
 
-__all__ = [mysql_table, mysql_row, mysql_count, register, privilege, key_mgmt]
+__all__ = [mysql_table, mysql_row, mysql_count, mysql_batch, mysql_aggregate, register, privilege, key_mgmt, cache_mgmt, pool_mgmt, catalog_mgmt, metrics_mgmt, profile_mgmt]
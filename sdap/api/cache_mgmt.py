@@ -0,0 +1,23 @@
+import logging
+import falcon
+
+from sdap import cache
+
+
+log = logging.getLogger(__name__)
+
+class CacheManagement(object):
+    def on_get(self, req, resp):
+        """Get the query cache statistics."""
+        resp.context['result'] = { 'result': 'ok', 'stats': cache.stats() }
+        resp.status = falcon.HTTP_200
+
+    def on_delete(self, req, resp):
+        """Reset the query cache statistics; with `flush=true` also drop every
+        cached query, authentication and schema."""
+        cache.reset_stats()
+        if req.get_param_as_bool('flush'):
+            cache.flush()
+            log.info("cache flushed")
+        resp.context['result'] = { 'result': 'ok' }
+        resp.status = falcon.HTTP_200
@@ -0,0 +1,22 @@
+import logging
+import falcon
+
+from sdap import catalog
+from sdap.db import LOCAL_CONN
+from sdap.config import shared_db_name
+
+
+log = logging.getLogger(__name__)
+
+class CatalogManagement(object):
+    def on_get(self, req, resp):
+        """Get the schema catalog of the shared database."""
+        current = catalog.get(LOCAL_CONN, shared_db_name())
+        resp.context['result'] = { 'result': 'ok', 'tables': current.tables }
+        resp.status = falcon.HTTP_200
+
+    def on_post(self, req, resp):
+        """Reload the schema catalog in every worker."""
+        catalog.reload()
+        resp.context['result'] = { 'result': 'ok' }
+        resp.status = falcon.HTTP_200
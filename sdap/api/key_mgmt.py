@@ -23,7 +23,7 @@ class KeyManagement(object):
     def on_delete(self, req, resp, app):
 
         def erase_key(user):
-            user.key = ''
+            user.revoke_key()
 
         with LOCAL_CONN.new_session() as session:
             User.modify_user(session, app, erase_key)
@@ -0,0 +1,20 @@
+import logging
+import falcon
+
+from sdap import metrics
+
+
+log = logging.getLogger(__name__)
+
+class MetricsManagement(object):
+    def on_get(self, req, resp):
+        """Get the metrics of all workers in the Prometheus text format."""
+        resp.body = metrics.exposition()
+        resp.content_type = 'text/plain; version=0.0.4'
+        resp.status = falcon.HTTP_200
+
+    def on_delete(self, req, resp):
+        """Reset the metrics."""
+        metrics.reset()
+        resp.context['result'] = { 'result': 'ok' }
+        resp.status = falcon.HTTP_200
@@ -1,79 +1,551 @@
+import re
+import json
+import hashlib
 import logging
 import falcon
 import base64
 
+from collections import OrderedDict
 from sdap import cache
-from sdap.user import user_db_engine
+from sdap.user import user_db_engine, privilege_fingerprint, user_grants
+from sdap.utils import etags_match
 from sqlalchemy.sql import text
-from sdap import config, exceptions
+from sdap import config, exceptions, formats, acl, bulk, filters, metrics, replicas
 #from sdap.utils import do_cprofile
 
 
 log = logging.getLogger(__name__)
 
 
-#@do_cprofile
-def _select(engine, table, id=None, columns=None, start=None, limit=None, where=None):
-    if not columns:
-        columns = engine.columns(table)
-    if type(columns) != list:
+TOTAL_EXACT = 'true'
+TOTAL_ESTIMATE = 'estimate'
+TOTAL_NONE = 'false'
+
+
+def _encode_cursor(last_id, order):
+    token = json.dumps({'id': last_id, 'order': order})
+    return base64.urlsafe_b64encode(token.encode('utf-8')).decode('ascii')
+
+
+def _decode_cursor(cursor):
+    """Decodes a cursor token into (last id, order)."""
+    try:
+        token = json.loads(base64.urlsafe_b64decode(str(cursor)).decode('utf-8'))
+        order = token['order']
+        if order not in ('asc', 'desc'):
+            raise ValueError(order)
+        return int(token['id']), order
+    except (TypeError, ValueError, KeyError):
+        raise exceptions.HTTPBadRequestError("Invalid cursor")
+
+
+def _estimate_rows(conn, table):
+    """Approximate row count of a table from InnoDB statistics; no scan involved."""
+    query = text("SELECT TABLE_ROWS FROM information_schema.TABLES "
+                 "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :table")
+    row = conn.execute(query, {'table': table}).fetchone()
+    return int(row[0]) if row and row[0] is not None else None
+
+
+def _explain_rows(conn, query, values):
+    """Approximate number of rows a query examines, from the optimizer's plan."""
+    plan = conn.execute(text("EXPLAIN " + query), values).fetchone()
+    if plan is None or plan['rows'] is None:
+        return None
+    rows = int(plan['rows'])
+    if 'filtered' in plan.keys() and plan['filtered'] is not None:
+        rows = int(round(rows * float(plan['filtered']) / 100))
+    return rows
+
+
+def _check_table(req, engine, table):
+    """Validates the table against the schema catalog; the request's metrics
+    are labelled with the table only once it is known to exist.
+
+    Raises:
+        NoSuchTableError: if the table does not exist.
+    """
+    engine.columns(table)
+    req.context['_table'] = table
+
+
+def _check_columns(engine, table, columns):
+    """Validates the table and column names of a query against the schema catalog.
+
+    Returns:
+        The column list; all columns of the table if `columns` is empty.
+
+    Raises:
+        NoSuchTableError: if the table does not exist.
+        HTTPBadRequestError: if a column does not exist.
+    """
+    if columns and type(columns) != list:
         columns = [columns]
-    sc = ','.join("`{}`".format(c) for c in columns)
+    known = engine.columns(table, columns or ())
+    if not columns:
+        return known
+    unknown = [c for c in columns if c not in known]
+    if unknown:
+        raise exceptions.HTTPBadRequestError("Invalid columns: {}".format(','.join(unknown)))
+    return columns
+
 
-    if ';' in sc:
-        raise exceptions.HTTPBadRequestError("Invalid columns: {}".format(sc))
-    if ';' in table:
-        raise exceptions.HTTPBadRequestError("Invalid table: {}".format(table))
+def _filter_clause(where=None, flt=None):
+    """Combines the raw `where` and the structured filter of a query.
 
-    scfr = "" if id else "SQL_CALC_FOUND_ROWS "
-    query = "SELECT {}{} FROM {}".format(scfr, sc, table)
-    sql_id = "WHERE id = :id"
-    sql_page = "WHERE id >= :start LIMIT :limit"
+    Returns:
+        (list of SQL conditions, bind values)
+    """
+    conditions = []
     values = {}
+    if where:
+        conditions.append("({})".format(where))
+    if flt:
+        conditions.append(flt.sql)
+        values.update(flt.params)
+    return conditions, values
+
+
+def _parse_filter(engine, table, doc):
+    """Compiles a structured filter on a table; None if there is none."""
+    if doc is None:
+        return None
+    return filters.compile_filter(doc, table, engine.schema(table))
+
+
+def _page_limit(limit):
+    """Parses the `limit` of a paginated read.
+
+    Returns:
+        The number of rows of a page, at most `db.page_size_max`.
+
+    Raises:
+        HTTPBadRequestError: if the limit is not a positive whole number.
+    """
+    try:
+        limit = int(limit)
+    except (TypeError, ValueError):
+        limit = 0
+    if limit < 1:
+        raise exceptions.HTTPBadRequestError("Invalid limit parameter")
+    return min(limit, config.option('db', 'page_size_max', 10000))
+
+
+def _build_select(engine, table, id=None, columns=None, start=None, limit=None, where=None,
+                  cursor=None, order=None, flt=None):
+    """Builds the SELECT statement of a table read; see `_select` for the parameters.
+
+    Returns:
+        (statement, bind values, requested columns, keyset page), where keyset page is
+        (page size, order) for keyset pagination and None otherwise. Under keyset
+        pagination, `id` is selected last if it is not among the requested columns.
+    """
+    columns = _check_columns(engine, table, columns)
+    # keyset pagination needs the id of the last row even if it is not requested
+    keyset = bool(cursor or (limit and not start)) and not id
+    query_columns = columns if not keyset or 'id' in columns else columns + ['id']
+    sc = ','.join("`{}`".format(c) for c in query_columns)
+
+    query = "SELECT {} FROM {}".format(sc, table)
+    conditions = []
+    values = {}
+    page = None
 
-    if start and limit:
+    if id:
         try:
-            query = text(' '.join([query, sql_page]))
-            values["start"] = int(start)
-            values["limit"] = int(limit)
-        except ValueError:
-            raise exceptions.HTTPBadRequestError("Invalid start or limit parameter")
-    elif id:
-        try:
-            query = text(' '.join([query, sql_id]))
+            conditions.append("id = :id")
             values["id"] = int(id)
         except ValueError:
             raise exceptions.HTTPBadRequestError("Invalid id")
-    elif where:
-        query = text(' '.join([query, "WHERE {}".format(where)]))
+    elif keyset:
+        if cursor:
+            after, order = _decode_cursor(cursor)
+            conditions.append("id {} :after".format('>' if order == 'asc' else '<'))
+            values["after"] = after
+        order = order or 'asc'
+        if order not in ('asc', 'desc'):
+            raise exceptions.HTTPBadRequestError("Invalid order")
+        page = (_page_limit(limit or config.option('db', 'page_size', 1000)), order)
+    elif start and limit:
+        try:
+            values["start"] = int(start)
+        except ValueError:
+            raise exceptions.HTTPBadRequestError("Invalid start parameter")
+        conditions.append("id >= :start")
+        values["limit"] = _page_limit(limit)
+    if not id:
+        filter_conditions, filter_values = _filter_clause(where, flt)
+        conditions.extend(filter_conditions)
+        values.update(filter_values)
+
+    if conditions:
+        query = ' '.join([query, "WHERE", ' AND '.join(conditions)])
+    if page:
+        # one extra row tells whether there is a next page
+        query = ' '.join([query, "ORDER BY id {} LIMIT :limit".format(page[1].upper())])
+        values["limit"] = page[0] + 1
+    elif start and limit:
+        query = ' '.join([query, "ORDER BY id LIMIT :limit"])
+
+    return text(query), values, columns, page
+
+
+#@do_cprofile
+def _select(engine, table, id=None, columns=None, start=None, limit=None, where=None,
+            cursor=None, order=None, total=None, flt=None):
+    """Selects rows of a table.
+
+    Rows may be filtered by a raw SQL condition `where` and/or a compiled
+    structured filter `flt` (see `sdap.filters`).
+
+    Pagination comes in two flavours:
+        `start` and `limit`: rows with id >= start, ordered by id.
+        `limit` (and `cursor`): keyset pagination ordered by id in `order` ('asc' or 'desc');
+            the result carries a cursor for the next page, or None on the last page.
+
+    `total` controls the row count returned along with the rows: 'true' for an exact
+    COUNT, 'estimate' for the table statistics (unfiltered queries only), 'false' for none.
+    Paginated queries default to 'estimate', since an exact count scans the whole table;
+    unpaginated queries count the returned rows.
+
+    Returns:
+        (selected columns, row tuples, total, next cursor)
+    """
+    query, values, columns, page = _build_select(engine, table, id=id, columns=columns, start=start,
+                                                limit=limit, where=where, cursor=cursor, order=order, flt=flt)
+
+    paginated = bool(page or (start and limit and not id))
+    if total is None:
+        total = TOTAL_ESTIMATE if paginated else TOTAL_EXACT
+    if total not in (TOTAL_EXACT, TOTAL_ESTIMATE, TOTAL_NONE):
+        raise exceptions.HTTPBadRequestError("Invalid total parameter")
 
     log.debug("select: about to execute")
+    count = None
     with engine.new_session() as conn:
         result = conn.execute(query, values).fetchall()
-        count = conn.execute("SELECT FOUND_ROWS()").fetchone()[0]
-
-    return [dict(zip(columns, r)) for r in result], count
-
+        if paginated and total == TOTAL_EXACT:
+            count_query = "SELECT COUNT(*) FROM {}".format(table)
+            conditions, count_values = _filter_clause(where, flt)
+            if conditions:
+                count_query = ' '.join([count_query, "WHERE", ' AND '.join(conditions)])
+            count = conn.execute(text(count_query), count_values).fetchone()[0]
+        elif paginated and total == TOTAL_ESTIMATE and not where and not flt:
+            count = _estimate_rows(conn, table)
+
+    next_cursor = None
+    if page and len(result) > page[0]:
+        result = result[:page[0]]
+        id_index = columns.index('id') if 'id' in columns else len(columns)
+        next_cursor = _encode_cursor(result[-1][id_index], page[1])
+    if page and 'id' not in columns:
+        rows = [tuple(r)[:-1] for r in result]
+    else:
+        rows = [tuple(r) for r in result]
+    if not paginated and total == TOTAL_EXACT:
+        count = len(rows)
+
+    return columns, rows, count, next_cursor
+
+
+def _stream_select(engine, table, columns=None, where=None, fmt=formats.JSON, flt=None):
+    """Selects rows of a table through a server-side cursor.
+
+    The statement is executed right away so that errors are reported as usual,
+    rows are fetched and encoded in chunks while the response is being sent.
+
+    Returns:
+        An iterable of encoded response chunks.
+    """
+    query, values, columns, _ = _build_select(engine, table, columns=columns, where=where, flt=flt)
+    conn = engine.connect().execution_options(stream_results=True)
+    try:
+        result = conn.execute(query, values)
+    except:
+        conn.close()
+        raise
+    return _stream_rows(conn, result, columns, fmt)
+
+
+def _stream_rows(conn, result, columns, fmt):
+    chunk_size = config.option('db', 'stream_chunk', 1000)
+    count = 0
+    try:
+        if fmt != formats.NDJSON:
+            yield b'{"result": "ok", "data": ['
+        while True:
+            rows = result.fetchmany(chunk_size)
+            if not rows:
+                break
+            encoded = [formats.dumps(dict(zip(columns, r))) for r in rows]
+            if fmt == formats.NDJSON:
+                chunk = '\n'.join(encoded) + '\n'
+            else:
+                chunk = (', ' if count else '') + ', '.join(encoded)
+            yield chunk.encode('utf-8')
+            count += len(rows)
+        if fmt != formats.NDJSON:
+            yield '], "total": {}}}'.format(count).encode('utf-8')
+    except Exception as ex:
+        # too late for an error response, the client sees a truncated body
+        log.exception(ex)
+    finally:
+        result.close()
+        conn.close()
+
+
+def _query_id(user, fmt, **params):
+    """Identifies a read within its table for caching.
+
+    The id carries the response format and the privilege fingerprint of the
+    app's DB user, so that apps only share entries if their grants are
+    identical. The query parameters, filter included, are hashed after
+    normalizing the column list (order is irrelevant to row objects).
+    The cache adds the table and its write generation to form the key.
+    """
+    columns = params.get('columns')
+    if columns is not None:
+        if type(columns) != list:
+            columns = [columns]
+        params['columns'] = sorted(set(columns)) if fmt == formats.JSON else columns
+    digest = hashlib.sha1(json.dumps(params, sort_keys=True).encode('utf-8')).hexdigest()
+    return "{}|{}|{}".format(privilege_fingerprint(user), fmt, digest)
+
+
+def _from_cache(req, resp, user, table, fmt, **params):
+    """Serves a read from the cache if possible.
+
+    For a GET whose If-None-Match names the entity tag of the body cached for
+    the query, the response is marked not modified without reading the body;
+    otherwise a cached body is handed to the response along with its tag.
+
+    Returns:
+        True if the cached body was handed to the response or the response is
+        not modified. Otherwise the handler should produce the result, which
+        ResponseCache then stores.
+    """
+    if not config.use_cache():
+        return False
+    query = _query_id(user, fmt, **params)
+    with metrics.phase('cache'):
+        if req.method == 'GET' and req.if_none_match:
+            tag = cache.cached_etag(table, query)
+            if tag is not None and etags_match(req, tag):
+                resp.etag = tag
+                resp.context['not_modified'] = True
+                return True
+        key, body, tag, leader = cache.fetch(table, query)
+    resp.context['cache_key'] = key
+    if body is None:
+        resp.context['cache_miss'] = True
+        resp.context['cache_leader'] = leader
+        return False
+    if req.method == 'GET':
+        resp.etag = tag
+    resp.context['cache_hit'] = body
+    return True
+
+
+def _read_engine(req, user, table):
+    """Engine for a read of a table: a replica, unless the client asked for the
+    primary (`primary=true`) or the table was written to moments ago."""
+    if not config.option('db', 'replicas') or req.get_param_as_bool('primary') or replicas.recently_written(table):
+        return user_db_engine(user)
+    return user_db_engine(user, read=True)
+
+
+def _writing(table):
+    """Sends the reads of a table to the primary before writing to it, so that
+    no read racing the write is served by a replica which has not seen it."""
+    replicas.note_write(table)
+
+
+def _written(table):
+    """Invalidates the cached reads of a table after a write, and keeps its
+    reads on the primary until the replicas have caught up.
+
+    The reads are sent to the primary before the generation is bumped: a read
+    served by a lagging replica in between would otherwise be cached under
+    the new generation.
+    """
+    replicas.note_write(table)
+    if config.use_cache():
+        cache.invalidate_table(table)
+
+
+def _authorize(user, engine, table, privilege, columns=None, where=None):
+    """Enforces the app's grants in proxy mode.
+
+    In the default mode the app's own MySQL user runs the query and MySQL
+    enforces its grants; in proxy mode the shared service connection would
+    allow anything, so the grants are checked here against the app's privilege
+    map. Columns default to all columns of the table. Raw `where` filters
+    cannot be checked and are refused.
+    """
+    if not config.proxy_mode():
+        return
+    if where:
+        raise exceptions.HTTPForbiddenError("Raw where filters are not allowed in proxy mode")
+    if privilege in ('SELECT', 'INSERT', 'UPDATE'):
+        if not columns:
+            columns = engine.columns(table)
+        if type(columns) != list:
+            columns = [columns]
+    if not acl.allowed(user_grants(user), table, privilege, columns):
+        raise exceptions.HTTPForbiddenError("Insufficent privileges")
+
+
+AGGREGATES = {
+    'count': "COUNT({})",
+    'count_distinct': "COUNT(DISTINCT {})",
+    'sum': "SUM({})",
+    'min': "MIN({})",
+    'max': "MAX({})",
+    'avg': "AVG({})",
+}
+
+_ALIAS = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+
+def _build_aggregate(engine, table, spec, where=None, flt=None):
+    """Compiles an aggregation spec into a SELECT ... GROUP BY statement.
+
+    Args:
+        spec(dict): group_by:  columns to group by (optional);
+                    metrics:   [{"fn": one of AGGREGATES, "column": ..., "as": alias}];
+                               column is optional for count, alias defaults to fn_column;
+                    order_by:  group columns or aliases, prefixed by '-' for descending order;
+                    limit:     maximum number of groups.
+        where(str): raw filter of the aggregated rows.
+        flt(Filter): structured filter of the aggregated rows.
+
+    Returns:
+        (statement, bind values, result columns, columns read)
+    """
+    engine.columns(table)  # validates the table
+    try:
+        group_by = spec.get('group_by') or []
+        if group_by:
+            group_by = _check_columns(engine, table, group_by)
+        metrics = spec['metrics']
+        if not metrics:
+            raise KeyError('metrics')
+        selected = ["`{}`".format(c) for c in group_by]
+        names = list(group_by)
+        read = list(group_by)
+        for metric in metrics:
+            fn = metric['fn']
+            if fn not in AGGREGATES:
+                raise exceptions.HTTPBadRequestError("Invalid aggregate: {}".format(fn))
+            column = metric.get('column')
+            if column:
+                read.extend(_check_columns(engine, table, [column]))
+            elif fn != 'count':
+                raise exceptions.HTTPMissingParamError("column of {}".format(fn))
+            alias = metric.get('as') or ('_'.join([fn, column]) if column else fn)
+            if not _ALIAS.match(alias) or alias in names:
+                raise exceptions.HTTPBadRequestError("Invalid alias: {}".format(alias))
+            selected.append("{} AS `{}`".format(AGGREGATES[fn].format("`{}`".format(column) if column else '*'), alias))
+            names.append(alias)
+    except (KeyError, TypeError, AttributeError) as ex:
+        raise exceptions.HTTPBadRequestError("Invalid aggregation: {}".format(ex))
+
+    query = "SELECT {} FROM {}".format(', '.join(selected), table)
+    conditions, values = _filter_clause(where, flt)
+    if conditions:
+        query = ' '.join([query, "WHERE", ' AND '.join(conditions)])
+    if group_by:
+        query = ' '.join([query, "GROUP BY", ','.join("`{}`".format(c) for c in group_by)])
+    order_by = []
+    items = spec.get('order_by') or []
+    for item in items if isinstance(items, list) else [items]:
+        name = item.lstrip('-') if isinstance(item, (type(''), type(u''))) else None
+        if name not in names:
+            raise exceptions.HTTPBadRequestError("Invalid order: {}".format(item))
+        order_by.append("`{}` {}".format(name, 'DESC' if item.startswith('-') else 'ASC'))
+    if order_by:
+        query = ' '.join([query, "ORDER BY", ','.join(order_by)])
+    limit = spec.get('limit')
+    if limit is not None:
+        try:
+            # a whole number, possibly given as a string
+            limit = int(limit) if not isinstance(limit, (bool, float)) else -1
+        except (TypeError, ValueError):
+            limit = -1
+        if limit < 0:
+            raise exceptions.HTTPBadRequestError("Invalid limit parameter")
+        values['limit'] = limit
+        query = ' '.join([query, "LIMIT :limit"])
+    return query, values, names, read
+
+
+class RDBTableAggregate(object):
+    def on_post(self, req, resp, table):
+        """Aggregate a table server-side; see `_build_aggregate` for the request body.
 
-def _make_key(engine, table, columns, start, limit):
-    if not columns:
-        columns = engine.columns(table)
-    columns = ','.join("`{}`".format(c) for c in sorted(columns)) if type(columns) == list else columns
-    key = "{}|{}|{}|{}".format(table, columns, start, limit)
-    return key
+        `filter` takes a structured filter (see `sdap.filters`), `where` the
+        same base64 raw filter as table reads.
+        """
+        user = req.context['user']
+        spec = req.context.get('doc') or {}
+        if not isinstance(spec, dict):
+            raise exceptions.HTTPBadRequestError("Invalid aggregation: the body must be an object")
+        spec = dict(spec)
+        where = base64.b64decode(spec.pop('where')) if spec.get('where') else None
+
+        engine = _read_engine(req, user, table)
+        _check_table(req, engine, table)
+        flt = _parse_filter(engine, table, spec.pop('filter', None))
+        query, values, names, read = _build_aggregate(engine, table, spec, where, flt)
+        _authorize(user, engine, table, 'SELECT', read + (flt.columns if flt else []) or ['id'], where)
+        fmt = formats.negotiate(req)
+        resp.context['format'] = fmt
+        if not _from_cache(req, resp, user, table, fmt, aggregate=spec, where=where, filter=flt.key if flt else None):
+            with engine.new_session() as conn:
+                rows = [tuple(r) for r in conn.execute(text(query), values).fetchall()]
+            resp.context['result'] = { 'result': 'ok', 'data': formats.shape_rows(fmt, names, rows) }
+        resp.status = falcon.HTTP_200
+        log.info("user [{}]: aggregate table [{}]".format(user['user'], table))
 
 
 class RDBTableCount(object):
     #@do_cprofile
     def on_get(self, req, resp, table):
-        """Get the number of rows."""
+        """Get the number of rows, optionally of filtered rows.
+
+        Exact counts are served from the query cache and invalidated by writes
+        to the table. With `estimate=1` an approximate count is returned instead,
+        from the table statistics or, for filtered counts, from EXPLAIN.
+        """
         user = req.context['user']
-        engine = user_db_engine(user)
-        query = "SELECT COUNT(id) FROM {}".format(table)
-        with engine.new_session() as session:
-            count = session.execute(query).fetchone()[0]
+        where = base64.b64decode(req.params['where']) if 'where' in req.params else None     # query filters
+        flt = filters.decode(req.params['filter']) if 'filter' in req.params else None       # structured filter
+        estimate = req.get_param_as_bool('estimate')                                         # approximate count
+
+        engine = _read_engine(req, user, table)
+        _check_table(req, engine, table)
+        flt = _parse_filter(engine, table, flt)
+        _authorize(user, engine, table, 'SELECT', flt.columns if flt else ['id'], where)
 
-        resp.context['result'] = { 'result': 'ok', 'count': count }
+        query = "SELECT COUNT(*) FROM {}".format(table)
+        conditions, values = _filter_clause(where, flt)
+        if conditions:
+            query = ' '.join([query, "WHERE", ' AND '.join(conditions)])
+
+        if estimate:
+            with engine.new_session() as conn:
+                if conditions:
+                    count = _explain_rows(conn, query, values)
+                else:
+                    count = _estimate_rows(conn, table)
+                if count is None:
+                    count = conn.execute(text(query), values).fetchone()[0]
+            resp.context['result'] = { 'result': 'ok', 'count': count, 'estimate': True }
+        elif not _from_cache(req, resp, user, table, formats.JSON, count=True, where=where,
+                             filter=flt.key if flt else None):
+            with engine.new_session() as conn:
+                count = conn.execute(text(query), values).fetchone()[0]
+            resp.context['result'] = { 'result': 'ok', 'count': count }
         resp.status = falcon.HTTP_200
 
 
@@ -85,56 +557,99 @@ class RDBTableAccess(object):
         columns = req.params['column'] if 'column' in req.params else None # columns to query
         start = req.params['start'] if 'start' in req.params else None     # pagination: start id
         limit = req.params['limit'] if 'limit' in req.params else None     # pagination: row limit
+        cursor = req.params['cursor'] if 'cursor' in req.params else None  # pagination: next page token
+        order = req.params['order'] if 'order' in req.params else None     # pagination: id order of pages
+        total = req.params['total'] if 'total' in req.params else None     # true, false or estimate
         where = base64.b64decode(req.params['where']) if 'where' in req.params else None     # query filters
+        flt = filters.decode(req.params['filter']) if 'filter' in req.params else None       # structured filter
+
+        engine = _read_engine(req, user, table)
+        _check_table(req, engine, table)
+        flt = _parse_filter(engine, table, flt)
+        _authorize(user, engine, table, 'SELECT', columns, where)
+        if flt:
+            _authorize(user, engine, table, 'SELECT', flt.columns)
+        if (start and limit) or cursor or limit:
+            # pages are delimited by id
+            _authorize(user, engine, table, 'SELECT', ['id'])
+        fmt = formats.stream_format(req)
+        if fmt:
+            if start or limit or cursor:
+                raise exceptions.HTTPBadRequestError("Pagination is not supported by streamed responses")
+            resp.stream = _stream_select(engine, table, columns=columns, where=where, fmt=fmt, flt=flt)
+            resp.content_type = formats.MEDIA_TYPES[fmt]
+            resp.context['stream'] = True
+            resp.status = falcon.HTTP_200
+            log.info("user [{}]: stream table({}) [{}]".format(user['user'], columns if columns else "*", table))
+            return
 
-        engine = user_db_engine(user)
-        key = _make_key(engine, table, columns, start, limit)
-        resp.context['cache_key'] = key
-        if config.use_cache() and cache.contains_query(key):
-            resp.context['cache_hit'] = True
+        fmt = formats.negotiate(req)
+        resp.context['format'] = fmt
+        if _from_cache(req, resp, user, table, fmt, columns=columns, start=start, limit=limit, cursor=cursor,
+                       order=order, total=total, where=where, filter=flt.key if flt else None):
             resp.status = falcon.HTTP_200
         else:
-            result, count = _select(engine, table, columns=columns, start=start, limit=limit, where=where)
+            selected, rows, count, next_cursor = _select(engine, table, columns=columns, start=start, limit=limit,
+                                                         where=where, cursor=cursor, order=order, total=total, flt=flt)
 
-            if config.use_cache():
-                resp.context['cache_miss'] = True
+            result = formats.shape_rows(fmt, selected, rows)
             resp.context['result'] = { 'result': 'ok', 'data': result, 'total': count }
+            if cursor or (limit and not start):
+                resp.context['result']['next'] = next_cursor
             resp.status = falcon.HTTP_200
 
-        pagi = " start from id {} limit {}".format(start, limit) if start and limit else ""
+        if start and limit:
+            pagi = " start from id {} limit {}".format(start, limit)
+        elif cursor or limit:
+            pagi = " cursor {} limit {}".format(cursor, limit)
+        else:
+            pagi = ""
         log.info("user [{}]: get table({}) [{}]{}".format(user['user'], columns if columns else "*", table, pagi))
 
     def on_post(self, req, resp, table):
-        """Create new row(s)."""
-        user = req.context['user']
-        try:
-            data = req.context['doc']
-            columns = data['columns']
-            keys = ','.join(["`{}`".format(c) for c in columns])
-            values_param = ','.join([":{}".format(c) for c in columns])
-            values = data['values']
-        except KeyError:
-            raise HTTPBadRequestError("Missing columns or values")
-
-        if values:
-            values_input = []
-            for value in values:
-                #value_clause.append(','.join(["'{}'".format(v) for v in value]))
-                values_input.append(dict(zip(columns, value)))
-            #values = ','.join(["({})".format(v) for v in value_clause])
-            engine = user_db_engine(user)
-            query = "INSERT INTO {} ({}) VALUES ({})".format(table, keys, values_param)
+        """Create new row(s).
 
-            with engine.new_session() as conn:
-                result = conn.execute(query, values_input)
-                count = result.rowcount
-            if config.use_cache():
-                cache.invalidate_query_pattern("{}|*".format(table))
-        else:
-            count = 0
+        Rows are inserted in chunks of `chunk` rows (`db.insert_chunk` by default),
+        each chunk committed by itself unless `atomic` is set. `on_duplicate` is
+        `ignore` or `update` to skip or overwrite rows with duplicate keys.
 
-        resp.context['result'] = {'result': 'ok', 'count': count}
-        resp.status = falcon.HTTP_201
+        Besides a JSON document, rows may be uploaded as NDJSON or CSV, which
+        are parsed and inserted while the body is being received.
+        """
+        user = req.context['user']
+        upload = formats.upload_format(req)
+        if upload:
+            columns, values = bulk.read_rows(req.stream, upload, req.content_length,
+                                             req.get_param_as_list('column'))
+        else:
+            try:
+                data = req.context['doc']
+                columns = data['columns']
+                values = data['values']
+            except KeyError:
+                raise exceptions.HTTPBadRequestError("Missing columns or values")
+        chunk = req.get_param_as_int('chunk')
+        atomic = req.get_param_as_bool('atomic') or False
+        mode = req.get_param('on_duplicate')
+
+        count, chunks, failed = 0, [], []
+        if values and columns:
+            engine = user_db_engine(user)
+            _check_table(req, engine, table)
+            _check_columns(engine, table, columns)
+            _authorize(user, engine, table, 'INSERT', columns)
+            if mode == bulk.UPDATE:
+                _authorize(user, engine, table, 'UPDATE', columns)
+            _writing(table)
+            try:
+                count, chunks, failed = bulk.insert_rows(engine, table, columns, values, chunk, mode, atomic)
+            finally:
+                _written(table)
+
+        resp.context['result'] = {'result': 'partial' if failed else 'ok', 'count': count,
+                                  'chunks': chunks, 'failed': failed}
+        resp.status = falcon.HTTP_207 if failed else falcon.HTTP_201
+        log.info("user [{}]: insert {} rows into [{}], {} chunks failed".format(user['user'], count, table, len(failed)))
 
 
 class RDBRowAccess(object):
@@ -142,16 +657,18 @@ class RDBRowAccess(object):
         """Retrieve a single row by id."""
         user = req.context['user']
         columns = req.params['column'] if 'column' in req.params else None
-        engine = user_db_engine(user)
-        key = _make_key(engine, table, columns, id, -1)
-        resp.context['cache_key'] = key
-        if config.use_cache() and cache.contains_query(key):
-            resp.context['cache_hit'] = True
+        engine = _read_engine(req, user, table)
+        _check_table(req, engine, table)
+        _authorize(user, engine, table, 'SELECT', columns)
+        _authorize(user, engine, table, 'SELECT', ['id'])
+        fmt = formats.negotiate(req)
+        resp.context['format'] = fmt
+        if _from_cache(req, resp, user, table, fmt, columns=columns, id=id):
             resp.status = falcon.HTTP_200
         else:
-            result, count = _select(engine, table, id=id, columns=columns)
+            selected, rows, _, _ = _select(engine, table, id=id, columns=columns)
 
-            resp.context['cache_miss'] = True
+            result = formats.shape_rows(fmt, selected, rows)
             resp.context['result'] = { 'result': 'ok', 'data': result }
             resp.status = falcon.HTTP_200
 
@@ -165,18 +682,21 @@ class RDBRowAccess(object):
         set_clause = ["`{}`=:{}".format(k, k) for k in keys]
         set_clause = ','.join(set_clause)
         engine = user_db_engine(user)
+        _check_table(req, engine, table)
+        _check_columns(engine, table, list(keys))
+        _authorize(user, engine, table, 'UPDATE', list(keys))
+        _authorize(user, engine, table, 'SELECT', ['id'])
         query = "UPDATE {} SET {} WHERE id=:id".format(table, set_clause)
         try:
             pairs['id'] = int(id)
         except ValueError:
             raise exceptions.HTTPBadRequestError("Invalid ID")
 
+        _writing(table)
         with engine.new_session() as conn:
             result = conn.execute(query, pairs)
 
-        if config.use_cache():
-            key = _make_key(engine, table, "*", id, -1)
-            cache.invalidate_query_pattern("{}".format(key))
+        _written(table)
         resp.context['result'] = {'result': 'ok'}
         resp.status = falcon.HTTP_200
 
@@ -184,11 +704,144 @@ class RDBRowAccess(object):
         """Delete an existing row."""
         user = req.context['user']
         engine = user_db_engine(user)
+        _check_table(req, engine, table)
+        _authorize(user, engine, table, 'DELETE')
+        _authorize(user, engine, table, 'SELECT', ['id'])
         query = "DELETE FROM {} WHERE id=:id".format(table)
 
+        _writing(table)
         with engine.new_session() as conn:
             result = conn.execute(query, { "id": id })
 
+        _written(table)
         resp.context['result'] = {'result': 'ok'}
         resp.status = falcon.HTTP_200
 
+
+
+def _int_ids(ids):
+    try:
+        return [int(i) for i in ids]
+    except (TypeError, ValueError):
+        raise exceptions.HTTPBadRequestError("Invalid id")
+
+
+def _id_params(ids, prefix):
+    """Bind parameters of an `IN` list of ids; returns (placeholders, values)."""
+    values = dict(("{}{}".format(prefix, n), i) for n, i in enumerate(ids))
+    return ','.join(":{}{}".format(prefix, n) for n in range(len(ids))), values
+
+
+def _batch_update(conn, table, updates):
+    """Updates several rows with a single statement, one CASE per column.
+
+    Args:
+        updates(dict): id -> {column: value}.
+    """
+    placeholders, values = _id_params(list(updates), 'i')
+    set_clause = []
+    columns = sorted(set(c for pairs in updates.values() for c in pairs))
+    for ci, column in enumerate(columns):
+        cases = []
+        for n, pairs in enumerate(updates.values()):
+            if column in pairs:
+                cases.append("WHEN :i{0} THEN :v{0}_{1}".format(n, ci))
+                values["v{}_{}".format(n, ci)] = pairs[column]
+        set_clause.append("`{0}` = CASE id {1} ELSE `{0}` END".format(column, ' '.join(cases)))
+    query = "UPDATE {} SET {} WHERE id IN ({})".format(table, ', '.join(set_clause), placeholders)
+    return conn.execute(text(query), values).rowcount
+
+
+class RDBBatch(object):
+    def on_post(self, req, resp, table):
+        """Read, update and delete many rows by id at once.
+
+        The body may contain:
+            get:     ids of rows to read;
+            columns: columns to read (all by default);
+            put:     [{"id": ..., "values": {column: value}}] of rows to update;
+            delete:  ids of rows to delete.
+
+        Updates and deletes run in one transaction, before the reads. Without
+        them, rows are served from the row cache where possible.
+        """
+        user = req.context['user']
+        data = req.context.get('doc') or {}
+        get_ids = list(OrderedDict.fromkeys(_int_ids(data.get('get', []))))
+        columns = data.get('columns')
+        delete_ids = _int_ids(data.get('delete', []))
+        updates = {}
+        try:
+            for item in data.get('put', []):
+                updates.setdefault(int(item['id']), {}).update(item['values'])
+        except (KeyError, TypeError, ValueError, AttributeError):
+            raise exceptions.HTTPBadRequestError("Invalid put item")
+        batch_max = config.option('db', 'batch_max', 1000)
+        if max(len(get_ids), len(updates), len(delete_ids)) > batch_max:
+            raise exceptions.HTTPBadRequestError("At most {} ids per operation".format(batch_max))
+
+        writes = bool(updates or delete_ids)
+        engine = user_db_engine(user) if writes else _read_engine(req, user, table)
+        _check_table(req, engine, table)  # whichever operations are requested
+        columns = _check_columns(engine, table, columns) if get_ids else columns
+        updated_columns = sorted(set(c for pairs in updates.values() for c in pairs))
+        if get_ids:
+            _authorize(user, engine, table, 'SELECT', columns)
+        if updates:
+            _check_columns(engine, table, updated_columns)
+            _authorize(user, engine, table, 'UPDATE', updated_columns)
+        if delete_ids:
+            _authorize(user, engine, table, 'DELETE')
+        _authorize(user, engine, table, 'SELECT', ['id'])
+
+        result = {'result': 'ok'}
+        rows = {}
+        pending = {}  # cache keys of rows read from the DB
+        use_cache = config.use_cache() and not writes
+        if use_cache and get_ids:
+            # same entries as single row reads
+            queries = [_query_id(user, formats.JSON, columns=data.get('columns'), id=str(i)) for i in get_ids]
+            for i, (key, body) in zip(get_ids, cache.fetch_many(table, queries)):
+                if body is None:
+                    pending[i] = key
+                else:
+                    cached = json.loads(body)['data']
+                    if cached:
+                        rows[i] = cached[0]
+            misses = list(pending)
+        else:
+            misses = get_ids
+
+        if writes:
+            _writing(table)
+        try:
+            with engine.new_session() as conn:
+                if updates:
+                    result['updated'] = _batch_update(conn, table, updates)
+                if delete_ids:
+                    placeholders, values = _id_params(delete_ids, 'd')
+                    query = "DELETE FROM {} WHERE id IN ({})".format(table, placeholders)
+                    result['deleted'] = conn.execute(text(query), values).rowcount
+                if misses:
+                    query_columns = columns if 'id' in columns else columns + ['id']
+                    placeholders, values = _id_params(misses, 'g')
+                    query = "SELECT {} FROM {} WHERE id IN ({})".format(
+                        ','.join("`{}`".format(c) for c in query_columns), table, placeholders)
+                    for r in conn.execute(text(query), values).fetchall():
+                        row = dict(zip(query_columns, r))
+                        rows[row['id']] = row if 'id' in columns else dict(zip(columns, r))
+        finally:
+            if writes:
+                _written(table)
+
+        if pending:
+            cache.set_queries(dict((key, formats.encode({'result': 'ok', 'data': [rows[i]] if i in rows else []},
+                                                        formats.JSON)) for i, key in pending.items()))
+        if get_ids:
+            result['data'] = [rows[i] for i in get_ids if i in rows]
+            result['missing'] = [i for i in get_ids if i not in rows]
+
+        resp.context['result'] = result
+        resp.status = falcon.HTTP_200
+        log.info("user [{}]: batch on [{}]: get {}, put {}, delete {}".format(
+            user['user'], table, len(get_ids), len(updates), len(delete_ids)))
@@ -0,0 +1,18 @@
+import os
+import logging
+import falcon
+
+from sdap import config
+from sdap.user import engine_pool, proxy_engine
+
+
+log = logging.getLogger(__name__)
+
+class PoolManagement(object):
+    def on_get(self, req, resp):
+        """Get the DB connection pool statistics of the worker serving the request."""
+        stats = engine_pool().stats()
+        if config.proxy_mode():
+            stats['proxy'] = proxy_engine().engine.pool.status()
+        resp.context['result'] = { 'result': 'ok', 'pid': os.getpid(), 'stats': stats }
+        resp.status = falcon.HTTP_200
@@ -4,7 +4,7 @@ import falcon
 import sdap.utils
 
 from sqlalchemy.orm import exc
-from sdap import exceptions
+from sdap import exceptions, cache
 from sdap.user import User
 from sdap.db import LOCAL_CONN
 from sdap.config import CONF, shared_db_name
@@ -92,6 +92,8 @@ class Privilege(object):
         with LOCAL_CONN.new_session() as session:
             for sql in sqls:
                 session.execute(sql)
+        # refreshes the privilege fingerprint, which scopes the app's cache entries
+        cache.invalidate_auth(app)
 
         resp.status = falcon.HTTP_200
         resp.context['result'] = { 'result': 'ok' }
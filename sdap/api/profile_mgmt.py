@@ -0,0 +1,67 @@
+import logging
+import falcon
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+from sdap import exceptions, profiler
+
+
+log = logging.getLogger(__name__)
+
+class ProfileManagement(object):
+    def on_get(self, req, resp):
+        """Get the profile stats merged over all workers.
+
+        By default the stats come in the pstats file format, which pstats,
+        snakeviz or flameprof read; with `format=text` as a printout of the
+        `limit` (default 50) functions of highest cumulative time.
+        """
+        if req.get_param('format') == 'text':
+            stats = profiler.merged()
+            if stats is None:
+                raise exceptions.HTTPNotFoundError("Nothing profiled")
+            out = StringIO()
+            stats.stream = out
+            stats.sort_stats('cumulative').print_stats(req.get_param_as_int('limit') or 50)
+            resp.body = out.getvalue()
+            resp.content_type = 'text/plain'
+        else:
+            data = profiler.dump_merged()
+            if data is None:
+                raise exceptions.HTTPNotFoundError("Nothing profiled")
+            resp.data = data
+            resp.content_type = 'application/octet-stream'
+            resp.append_header('Content-Disposition', 'attachment; filename="sdap.pstats"')
+        resp.status = falcon.HTTP_200
+
+    def on_post(self, req, resp):
+        """Start profiling a sample of the requests; discards earlier stats.
+
+        Body: {"rate": fraction of requests, "route": path prefix (optional),
+               "app": app name (optional), "duration": seconds (optional)}
+        """
+        doc = req.context.get('doc') or {}
+        try:
+            rate = float(doc['rate'])
+            duration = int(doc['duration']) if doc.get('duration') else None
+        except KeyError:
+            raise exceptions.HTTPMissingParamError("rate")
+        except (TypeError, ValueError):
+            raise exceptions.HTTPBadRequestError("Invalid rate or duration")
+        if not 0 < rate <= 1:
+            raise exceptions.HTTPBadRequestError("Rate must be within (0, 1]")
+        settings = profiler.start(rate, doc.get('route'), doc.get('app'), duration)
+        log.info("profiling started: {}".format(settings))
+        resp.context['result'] = { 'result': 'ok', 'profile': settings }
+        resp.status = falcon.HTTP_200
+
+    def on_delete(self, req, resp):
+        """Stop profiling; with `clear=true` the stats are deleted as well."""
+        profiler.stop()
+        if req.get_param_as_bool('clear'):
+            profiler.clear()
+        resp.context['result'] = { 'result': 'ok' }
+        resp.status = falcon.HTTP_200
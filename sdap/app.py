@@ -1,5 +1,8 @@
 # -*- coding: utf-8 -*-
 
+from timeit import default_timer
+_started = default_timer()
+
 import logging
 import logging.config
 import falcon
@@ -7,14 +10,16 @@ import falcon
 #from werkzeug.contrib.profiler import ProfilerMiddleware
 from sqlalchemy import exc
 from sdap.utils import *
-from sdap import api, logconf
+from sdap.metrics import Metrics
+from sdap.profiler import Profiler
+from sdap import api, logconf, config
 
 
-logging.config.dictConfig(logconf.conf_dict)
+logging.config.dictConfig(logconf.conf_dict())
 log = logging.getLogger(__name__)
 
 # middlewares
-app = falcon.API(middleware=[RequireJSON(), StreamReader(), Logger(), ResponseCache(), JSONTranslator(), RequireAuth(), AdminCheck()])
+app = falcon.API(middleware=[Metrics(), Profiler(), RequireJSON(), StreamReader(), Logger(), ConditionalGet(), ResponseCache(), JSONTranslator(), RequireAuth(), AdminCheck()])
 
 # error handlers
 app.add_error_handler(exc.DBAPIError, handle_db_exception)
@@ -26,9 +31,27 @@ app.add_error_handler(exc.OperationalError, handle_sql_exception)
 app.add_route("/register", api.register)
 app.add_route("/privilege/{app}", api.privilege)
 app.add_route("/key/{app}", api.key_mgmt)
+app.add_route("/cache", api.cache_mgmt)
+app.add_route("/pool", api.pool_mgmt)
+app.add_route("/catalog", api.catalog_mgmt)
+app.add_route("/metrics", api.metrics_mgmt)
+app.add_route("/profile", api.profile_mgmt)
 app.add_route("/data/{table}", api.mysql_table)
+app.add_route("/data/{table}/_batch", api.mysql_batch)
 app.add_route("/data/{table}/{id}", api.mysql_row)
 app.add_route("/count/{table}", api.mysql_count)
+app.add_route("/aggregate/{table}", api.mysql_aggregate)
 
 # profiling
 #app = ProfilerMiddleware(app, sort_by=("cumulative",), restrictions=(.05,))
+
+# uwsgi loads the app once and forks the workers from it: connections are
+# only opened after fork, by each worker
+try:
+    from uwsgidecorators import postfork
+except ImportError:
+    postfork = None
+if postfork is not None and config.option('app', 'warm_up', True):
+    postfork(init_worker)
+
+log.info("app loaded in %.3fs", default_timer() - _started)
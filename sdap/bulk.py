@@ -0,0 +1,240 @@
+import csv
+import sys
+import json
+import logging
+
+from itertools import chain
+from sqlalchemy import exc
+from sqlalchemy.sql import text
+from sdap import config, exceptions, formats
+
+
+log = logging.getLogger(__name__)
+
+# duplicate key handling
+IGNORE = 'ignore'    # INSERT IGNORE: keep existing rows
+UPDATE = 'update'    # ON DUPLICATE KEY UPDATE: overwrite existing rows
+
+
+class ParseError(exceptions.HTTPBadRequestError):
+    """A malformed row in a streamed upload."""
+    pass
+
+
+def _statement(table, columns, rows, mode):
+    """Builds a multi-row INSERT of `rows` rows with parameters named `r<row>_<column index>`."""
+    names = ','.join("`{}`".format(c) for c in columns)
+    values = ','.join("({})".format(','.join(":r{}_{}".format(r, i) for i in range(len(columns))))
+                      for r in range(rows))
+    query = "INSERT {}INTO {} ({}) VALUES {}".format("IGNORE " if mode == IGNORE else "", table, names, values)
+    if mode == UPDATE:
+        query = "{} ON DUPLICATE KEY UPDATE {}".format(query, ','.join("`{0}`=VALUES(`{0}`)".format(c) for c in columns))
+    return text(query)
+
+
+def _params(columns, chunk, offset):
+    params = {}
+    for r, row in enumerate(chunk):
+        if not isinstance(row, (list, tuple)):
+            raise exceptions.HTTPBadRequestError("Row {} is not a list of values".format(offset + r))
+        if len(row) != len(columns):
+            raise exceptions.HTTPBadRequestError("Row {} has {} values, {} expected".format(
+                offset + r, len(row), len(columns)))
+        for i, value in enumerate(row):
+            params["r{}_{}".format(r, i)] = value
+    return params
+
+
+def _chunks(rows, size):
+    """Groups rows into lists of `size` rows.
+
+    Yields:
+        (rows, error): error is the `ParseError` raised while reading the
+        rows of an upload, which ends the grouping; the rows read before
+        it are yielded along with it.
+    """
+    rows = iter(rows)
+    while True:
+        chunk = []
+        try:
+            for row in rows:
+                chunk.append(row)
+                if len(chunk) == size:
+                    break
+        except ParseError as ex:
+            yield chunk, ex
+            return
+        if not chunk:
+            return
+        yield chunk, None
+
+
+def insert_rows(engine, table, columns, rows, chunk_size=None, mode=None, atomic=False):
+    """Inserts rows with multi-row INSERT statements.
+
+    Rows are consumed lazily, so at most one chunk is held in memory.
+
+    Args:
+        engine(DBEngine): engine to insert with.
+        table(str):       table name, validated by the caller.
+        columns(list):    column names, validated by the caller.
+        rows(iterable):   value lists in the order of `columns`.
+        chunk_size(int):  rows per statement, `db.insert_chunk` by default.
+        mode(str):        None, `IGNORE` or `UPDATE`; how to treat duplicate keys.
+        atomic(bool):     if set, all rows are inserted in one transaction and any
+                          error aborts the whole insertion. Otherwise every chunk is
+                          committed by itself, and failed chunks are reported.
+
+    A malformed row of an upload ends the insertion. Without `atomic` the
+    rows before it are still inserted, and it is reported as a failure of
+    one row at its offset; the rows after it are not read.
+
+    Returns:
+        (affected rows, chunk reports, failure reports). A chunk report is
+        {'offset', 'rows', 'count'}, a failure report {'offset', 'rows', 'error'}.
+    """
+    chunk_size = chunk_size or config.option('db', 'insert_chunk', 1000)
+    if chunk_size < 1:
+        raise exceptions.HTTPBadRequestError("Invalid chunk size")
+    if mode not in (None, IGNORE, UPDATE):
+        raise exceptions.HTTPBadRequestError("Invalid duplicate key mode: {}".format(mode))
+
+    statements = {}  # by number of rows; only the last chunk differs
+    count, reports, failures = 0, [], []
+    offset = 0
+
+    def execute(conn, chunk):
+        if len(chunk) not in statements:
+            statements[len(chunk)] = _statement(table, columns, len(chunk), mode)
+        return conn.execute(statements[len(chunk)], _params(columns, chunk, offset)).rowcount
+
+    if atomic:
+        with engine.new_session() as conn:
+            for chunk, error in _chunks(rows, chunk_size):
+                if error is not None:
+                    raise error
+                affected = execute(conn, chunk)
+                reports.append({'offset': offset, 'rows': len(chunk), 'count': affected})
+                count += affected
+                offset += len(chunk)
+        return count, reports, failures
+
+    for chunk, parse_error in _chunks(rows, chunk_size):
+        if chunk:
+            try:
+                with engine.new_session() as conn:
+                    affected = execute(conn, chunk)
+                reports.append({'offset': offset, 'rows': len(chunk), 'count': affected})
+                count += affected
+            except (exc.DBAPIError, exc.StatementError, exceptions.HTTPBadRequestError) as ex:
+                error = getattr(ex, 'orig', None) or getattr(ex, 'message', None) or ex
+                log.warning("insert into [{}] failed at row {}: {}".format(table, offset, error))
+                failures.append({'offset': offset, 'rows': len(chunk), 'error': str(error)})
+            offset += len(chunk)
+        if parse_error is not None:
+            log.warning("upload into [{}] stopped at row {}: {}".format(table, offset, parse_error.message))
+            failures.append({'offset': offset, 'rows': 1, 'error': parse_error.message})
+    return count, reports, failures
+
+
+def _lines(stream, length, block=65536, blank=False):
+    """Reads lines (with their line ending) from a stream of `length` bytes.
+
+    Blank lines are skipped unless `blank` is set.
+    """
+    remaining = length
+    pending = b''
+    while remaining is None or remaining > 0:
+        data = stream.read(block if remaining is None else min(block, remaining))
+        if not data:
+            break
+        if remaining is not None:
+            remaining -= len(data)
+        lines = (pending + data).split(b'\n')
+        pending = lines.pop()
+        for line in lines:
+            if blank or line.strip():
+                yield line + b'\n'
+    if pending.strip():
+        yield pending
+
+
+def _ndjson_rows(lines, columns):
+    """Parses NDJSON lines into value lists.
+
+    Lines are arrays in column order, or objects. Columns are taken from
+    `columns`, else from a leading `{"columns": [...]}` line, else from the
+    keys of the first object.
+    """
+    def parse(line):
+        try:
+            doc = json.loads(line.decode('utf-8'))
+        except (ValueError, UnicodeDecodeError):
+            raise ParseError("Malformed JSON line: {}".format(line[:80]))
+        if not isinstance(doc, (list, dict)):
+            raise ParseError("JSON line is not an array or object: {}".format(line[:80]))
+        return doc
+
+    docs = (parse(line) for line in lines)
+    first = next(docs, None)
+    if first is None:
+        return columns, iter([])
+    if isinstance(first, dict) and list(first.keys()) == ['columns']:
+        columns = columns or first['columns']
+    else:
+        docs = chain([first], docs)
+        if not columns and isinstance(first, dict):
+            columns = sorted(first.keys())
+    if not columns:
+        raise exceptions.HTTPMissingParamError("columns")
+
+    def values(doc):
+        if isinstance(doc, dict):
+            return [doc.get(c) for c in columns]
+        return doc
+    return columns, (values(doc) for doc in docs)
+
+
+def _csv_rows(lines, columns):
+    """Parses CSV lines into value lists; the first row names the columns.
+
+    Empty fields are inserted as NULL, blank lines outside quoted fields
+    are skipped.
+    """
+    if sys.version_info[0] >= 3:
+        # the csv module reads bytes on python 2 and text on python 3
+        lines = (line.decode('utf-8') for line in lines)
+
+    reader = csv.reader(lines)
+
+    def read():
+        try:
+            for record in reader:
+                if record:
+                    yield record
+        except (csv.Error, UnicodeDecodeError) as ex:
+            raise ParseError("Malformed CSV line {}: {}".format(reader.line_num, ex))
+
+    records = read()
+    header = next(records, None)
+    if header is None:
+        return columns, iter([])
+    return columns or header, ([v if v != '' else None for v in record] for record in records)
+
+
+def read_rows(stream, fmt, length=None, columns=None):
+    """Parses a streamed upload incrementally.
+
+    Args:
+        stream(file):  the request stream.
+        fmt(str):      `formats.NDJSON` or `formats.CSV`.
+        length(int):   content length, None to read until the end of the stream.
+        columns(list): column names, overriding those found in the upload.
+
+    Returns:
+        (columns, iterable of value lists)
+    """
+    if fmt == formats.CSV:
+        # quoted fields may span blank lines
+        return _csv_rows(_lines(stream, length, blank=True), columns)
+    return _ndjson_rows(_lines(stream, length), columns)
@@ -1,26 +1,321 @@
-import pickle
+import os
+import json
+import time
+import hashlib
+import zlib
 import redis
 
-from config import CONF
+from sdap import config
 
 
-_conf = CONF['redis']
-_conn = redis.StrictRedis(host=_conf['addr'], port=_conf['port'], db=0)
-_conn.flushall()
+_STATS = 'stats|cache'
+# version of all query keys; bumping it drops every cached query at once
+_NAMESPACE = 'cache|namespace'
 
+_client = None
+_client_pid = None
+_scripts = {}
 
-def contains_query(query):
-    exists = _conn.exists(query)
-    return exists
 
-def cached_query(query):
-    cached = _conn.get(query)
-    return cached
+def _conf():
+    return config.CONF['redis']
 
-def invalidate_query_pattern(pattern):
-    keys = [key for key in _conn.scan_iter(match=pattern)]
+def connection():
+    """The redis connection of the current process, opened on first use.
+
+    Other modules keep their shared state in redis through it as well. A
+    process forked after the connection was opened opens its own.
+    """
+    global _client, _client_pid
+    if _client_pid != os.getpid():
+        conf = _conf()
+        _client = redis.StrictRedis(host=conf['addr'], port=conf['port'], db=0)
+        _client_pid = os.getpid()
+        _scripts.clear()
+    return _client
+
+def _script(source):
+    client = connection()
+    script = _scripts.get(source)
+    if script is None:
+        script = _scripts[source] = client.register_script(source)
+    return script
+
+# Looks a query up in one round trip: resolves the namespace and the table
+# generation into the key, reads the body, counts the outcome and, on a miss, elects the caller
+# to fill the entry unless another worker is already doing so.
+_FETCH = """
+local key = ARGV[1] .. (redis.call('GET', KEYS[3]) or '0') .. '|' .. (redis.call('GET', KEYS[1]) or '0') .. ARGV[2]
+local body = redis.call('GET', key)
+local outcome = 'hits'
+local leader = 0
+if not body then
+    outcome = 'misses'
+    if tonumber(ARGV[4]) == 0 or redis.call('SET', 'lock|' .. key, '1', 'NX', 'PX', ARGV[4]) then
+        leader = 1
+    end
+end
+redis.call('HINCRBY', KEYS[2], outcome, 1)
+redis.call('HINCRBY', KEYS[2], ARGV[3] .. '|' .. outcome, 1)
+return {key, body, leader}
+"""
+
+# Reads several query bodies of a table in one round trip; ARGV holds the
+# key prefix, the table and the query suffixes.
+_FETCH_MANY = """
+local generation = (redis.call('GET', KEYS[3]) or '0') .. '|' .. (redis.call('GET', KEYS[1]) or '0')
+local keys = {}
+for i = 3, #ARGV do
+    keys[i - 2] = ARGV[1] .. generation .. ARGV[i]
+end
+local bodies = redis.call('MGET', unpack(keys))
+local hits = 0
+for i = 1, #keys do
+    if bodies[i] then
+        hits = hits + 1
+    end
+end
+redis.call('HINCRBY', KEYS[2], 'hits', hits)
+redis.call('HINCRBY', KEYS[2], 'misses', #keys - hits)
+redis.call('HINCRBY', KEYS[2], ARGV[2] .. '|hits', hits)
+redis.call('HINCRBY', KEYS[2], ARGV[2] .. '|misses', #keys - hits)
+return {keys, bodies}
+"""
+
+# Reads the entity tag stored with a cached query, without its body.
+_TAG = """
+local key = ARGV[1] .. (redis.call('GET', KEYS[2]) or '0') .. '|' .. (redis.call('GET', KEYS[1]) or '0') .. ARGV[2]
+return redis.call('GETRANGE', key, 1, ARGV[3])
+"""
+
+# Stored bodies are a format flag, the digest of the body (see `etag`) and
+# the body, compressed or not.
+_RAW = b'r'
+_ZLIB = b'z'
+_DIGEST = 20
+
+
+def _digest(body):
+    return hashlib.sha1(body).hexdigest()[:_DIGEST]
+
+def etag(body):
+    """Entity tag of a response body, derived from its content."""
+    if not isinstance(body, bytes):
+        body = body.encode('utf-8')
+    return '"{}"'.format(_digest(body))
+
+def _pack(body):
+    if not isinstance(body, bytes):
+        body = body.encode('utf-8')
+    digest = _digest(body).encode('ascii')
+    if len(body) >= _conf().get('compress_min', 16384) > 0:
+        return _ZLIB + digest + zlib.compress(body, 1)
+    return _RAW + digest + body
+
+def _text(key):
+    # redis replies are bytes on python 3
+    return key.decode('utf-8') if isinstance(key, bytes) else key
+
+def _unpack(stored):
+    if stored is None:
+        return None
+    if stored[:1] == _ZLIB:
+        return zlib.decompress(stored[1 + _DIGEST:])
+    return stored[1 + _DIGEST:]
+
+def _tag(stored):
+    return '"{}"'.format(_text(stored[1:1 + _DIGEST])) if stored else None
+
+
+def fetch(table, query):
+    """Reads a cached query body of a table.
+
+    If the query is not cached but another worker is already running it,
+    waits up to `redis.coalesce_wait` ms for that worker to store the result.
+    The wait ends early once the worker releases its fill lock without
+    storing anything, e.g. because its query failed or its body is too large.
+
+    Args:
+        table(str): the table queried.
+        query(str): identifies the query within the table.
+
+    Returns:
+        (cache key, body, entity tag, leader), where body and tag are None on
+        a miss; the caller should then run the query and store its result with
+        `set_query`. leader tells whether the caller holds the fill lock,
+        rather than having given up waiting for another worker.
+    """
+    wait = _conf().get('coalesce_wait', 2000)
+    key, stored, leader = _script(_FETCH)(keys=['gen|{}'.format(table), _STATS, _NAMESPACE],
+                                          args=['q|{}|'.format(table), '|{}'.format(query), table, wait])
+    key = _text(key)
+    if stored is None and not leader:
+        deadline = time.time() + wait / 1000.0
+        locked = True
+        while stored is None and locked and time.time() < deadline:
+            time.sleep(0.02)
+            # the body is stored before the lock is released, so a missing
+            # lock without a body means there is nothing to wait for
+            stored, locked = connection().mget(key, 'lock|{}'.format(key))
+    return key, _unpack(stored), _tag(stored), bool(leader)
+
+def fetch_many(table, queries):
+    """Reads several cached query bodies of a table at once.
+
+    Returns:
+        [(cache key, body)] in the order of `queries`, body being None on a miss.
+    """
+    if not queries:
+        return []
+    keys, bodies = _script(_FETCH_MANY)(keys=['gen|{}'.format(table), _STATS, _NAMESPACE],
+                                        args=['q|{}|'.format(table), table] + ['|{}'.format(q) for q in queries])
+    return [(_text(key), _unpack(body)) for key, body in zip(keys, bodies)]
+
+def set_queries(bodies):
+    """Stores several query bodies, given as {cache key: body}."""
+    pipe = connection().pipeline(transaction=False)
+    for query, records in bodies.items():
+        pipe.set(query, _pack(records), ex=_conf()['expire'])
+    pipe.execute()
+
+def stats():
+    """Returns the cache counters shared by all workers, along with redis eviction figures."""
+    counters = dict((_text(field), int(value)) for field, value in connection().hgetall(_STATS).items())
+    info = connection().info()
+    tables = {}
+    for field, value in counters.items():
+        table, sep, outcome = field.rpartition('|')
+        if sep:
+            tables.setdefault(table, {'hits': 0, 'misses': 0})[outcome] = value
+    hits = counters.get('hits', 0)
+    misses = counters.get('misses', 0)
+    return {
+        'hits': hits,
+        'misses': misses,
+        'hit_ratio': float(hits) / (hits + misses) if hits + misses else None,
+        'tables': tables,
+        'expire': _conf()['expire'],
+        'evicted_keys': info.get('evicted_keys'),
+        'expired_keys': info.get('expired_keys'),
+        'used_memory': info.get('used_memory'),
+        'maxmemory': info.get('maxmemory'),
+    }
+
+def reset_stats():
+    connection().delete(_STATS)
+
+def table_generation(table):
+    """Returns the write generation of a table.
+
+    Query keys embed the generation of their table, so bumping it
+    invalidates every cached query of the table at once.
+    """
+    generation = connection().get('gen|{}'.format(table))
+    return _text(generation) if generation is not None else '0'
+
+def cached_etag(table, query):
+    """Returns the entity tag of a query body cached at the table's current
+    generation, without reading the body; None if it is not cached."""
+    tag = _script(_TAG)(keys=['gen|{}'.format(table), _NAMESPACE],
+                        args=['q|{}|'.format(table), '|{}'.format(query), _DIGEST])
+    return '"{}"'.format(_text(tag)) if tag else None
+
+def invalidate_table(table):
+    """Invalidates all cached queries of a table; O(1) regardless of their number."""
+    connection().incr('gen|{}'.format(table))
+
+def set_query(query, records, leader=True):
+    """Stores a query body fetched by `fetch` and, if the caller was elected
+    to fill it (`leader`), releases its fill lock.
+
+    A None body (the query failed) or one above `redis.max_size` bytes only
+    releases the lock, so that waiting workers run the query themselves
+    right away. A worker which gave up waiting never releases the lock, which
+    belongs to the worker still running the query.
+    """
+    pipe = connection().pipeline(transaction=False)
+    if records is not None and len(records) <= _conf().get('max_size', 10 * 1024 * 1024):
+        pipe.set(query, _pack(records), ex=_conf()['expire'])
+    if leader:
+        pipe.delete('lock|{}'.format(query))
+    pipe.execute()
+
+
+_AUTH_GENERATION = 'auth|gen'
+
+# Stores an authentication result unless an invalidation happened since the
+# generation in ARGV[1] was read; KEYS are the generation, the entry and the
+# app's set of entries (empty for an invalid key).
+_SET_AUTH = """
+if (redis.call('GET', KEYS[1]) or '') ~= ARGV[1] then
+    return 0
+end
+redis.call('SET', KEYS[2], ARGV[2], 'EX', ARGV[3])
+if KEYS[3] ~= '' then
+    redis.call('SADD', KEYS[3], ARGV[4])
+    redis.call('EXPIRE', KEYS[3], ARGV[3])
+end
+return 1
+"""
+
+def auth_generation():
+    """Returns a token which changes whenever any cached authentication is invalidated."""
+    return connection().get(_AUTH_GENERATION)
+
+def cached_auth(digest):
+    cached = connection().get('auth|{}'.format(digest))
+    return json.loads(cached) if cached is not None else None
+
+def set_auth(digest, info, ttl, generation):
+    """Shares an authentication result with other workers.
+
+    An empty `info` records an invalid key. The result is dropped if any
+    authentication was invalidated since `generation` (see `auth_generation`)
+    was read before looking the key up: it may then stem from a key which was
+    revoked or replaced meanwhile.
+
+    Returns:
+        True if the result was stored.
+    """
+    app_key = 'auth|app|{}'.format(info['app']) if info else ''
+    stored = _script(_SET_AUTH)(keys=[_AUTH_GENERATION, 'auth|{}'.format(digest), app_key],
+                                args=[generation or '', json.dumps(info), ttl, digest])
+    return bool(stored)
+
+def invalidate_auth(app):
+    """Drops the cached authentications of an app in every worker."""
+    app_key = 'auth|app|{}'.format(app)
+    keys = ['auth|{}'.format(_text(d)) for d in connection().smembers(app_key)]
+    pipe = connection().pipeline()
     if keys:
-        _conn.delete(*keys)
+        pipe.delete(*keys)
+    pipe.delete(app_key)
+    pipe.incr(_AUTH_GENERATION)
+    pipe.execute()
+
+
+_CATALOG_VERSION = 'catalog|version'
+
+def catalog_version():
+    return connection().get(_CATALOG_VERSION)
+
+def bump_catalog_version():
+    connection().incr(_CATALOG_VERSION)
+
+
+def flush():
+    """Drops every cached query, authentication and schema in all workers.
 
-def set_query(query, records):
-    _conn.set(query, records, ex=_conf['expire'])
+    Replaces the FLUSHALL formerly run at import: other data in redis
+    (statistics, metrics, profiler settings) is kept, and entries of the old
+    namespace simply expire.
+    """
+    conn = connection()
+    auth = [key for key in conn.scan_iter('auth|*') if key not in (_AUTH_GENERATION, _AUTH_GENERATION.encode())]
+    pipe = conn.pipeline()
+    pipe.incr(_NAMESPACE)
+    if auth:
+        pipe.delete(*auth)
+    pipe.incr(_AUTH_GENERATION)
+    pipe.incr(_CATALOG_VERSION)
+    pipe.execute()
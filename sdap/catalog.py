@@ -0,0 +1,127 @@
+import time
+import logging
+
+from sqlalchemy import exc
+from sqlalchemy.sql import text
+from sdap import cache, config
+
+
+log = logging.getLogger(__name__)
+
+# columns and their index memberships of all tables of a database, in one query
+_LOAD = text("""
+SELECT c.TABLE_NAME, c.COLUMN_NAME, c.COLUMN_TYPE, s.INDEX_NAME, s.SEQ_IN_INDEX, s.NON_UNIQUE
+FROM information_schema.COLUMNS c
+LEFT JOIN information_schema.STATISTICS s
+    ON s.TABLE_SCHEMA = c.TABLE_SCHEMA AND s.TABLE_NAME = c.TABLE_NAME AND s.COLUMN_NAME = c.COLUMN_NAME
+WHERE c.TABLE_SCHEMA = :db
+ORDER BY c.TABLE_NAME, c.ORDINAL_POSITION, s.INDEX_NAME
+""")
+
+_catalogs = {}
+
+
+class Catalog(object):
+    """Schema of the tables of a database.
+
+    Each table is described by a dict:
+        columns:     column names, in table order.
+        types:       column name -> column type.
+        primary_key: column names of the primary key.
+        indexes:     index name -> {'unique': bool, 'columns': column names in index order}.
+    """
+    def __init__(self, db, tables, version):
+        self.db = db
+        self.tables = tables
+        self.version = version
+        self.loaded = self.checked = time.time()
+
+    def table(self, name):
+        """Describes a table.
+
+        Raises:
+            NoSuchTableError: if the table does not exist.
+        """
+        try:
+            return self.tables[name]
+        except KeyError:
+            raise exc.NoSuchTableError(name)
+
+
+def _load(engine, db):
+    tables = {}
+    with engine.new_session() as session:
+        rows = session.execute(_LOAD, {'db': db}).fetchall()
+    for table, column, column_type, index, seq, non_unique in rows:
+        schema = tables.setdefault(table, {'columns': [], 'types': {}, 'primary_key': [], 'indexes': {}})
+        if column not in schema['types']:
+            schema['columns'].append(column)
+            schema['types'][column] = column_type
+        if index is not None:
+            schema['indexes'].setdefault(index, {'unique': not non_unique, 'columns': []})['columns'].append((seq, column))
+    for schema in tables.values():
+        for index in schema['indexes'].values():
+            index['columns'] = [c for _, c in sorted(index['columns'])]
+        if 'PRIMARY' in schema['indexes']:
+            schema['primary_key'] = schema['indexes']['PRIMARY']['columns']
+    log.info("loaded schema of database [{}]: {} tables".format(db, len(tables)))
+    return tables
+
+
+def get(engine, db):
+    """Gets the catalog of a database, loading it if needed.
+
+    A catalog is reloaded after `catalog.ttl` seconds, or when `reload` was called
+    by any worker; the latter is checked at most every `catalog.check_interval` seconds.
+
+    Args:
+        engine(DBEngine): engine allowed to read the schema of `db`.
+        db(str):          database name.
+    """
+    now = time.time()
+    current = _catalogs.get(db)
+    if current is not None and now - current.loaded < config.option('catalog', 'ttl', 3600):
+        if now - current.checked < config.option('catalog', 'check_interval', 5):
+            return current
+        current.checked = now
+        if cache.catalog_version() == current.version:
+            return current
+    return _reload(engine, db)
+
+
+def table(engine, db, name, columns=()):
+    """Describes a table of a database.
+
+    A table or one of `columns` missing from the catalog may have been created
+    after it was loaded, so the catalog is reloaded first; at most once every
+    `catalog.check_interval` seconds, as a miss may as well be a typo.
+
+    Args:
+        engine(DBEngine): engine allowed to read the schema of `db`.
+        db(str):          database name.
+        name(str):        table name.
+        columns(list):    column names the caller is about to use.
+
+    Raises:
+        NoSuchTableError: if the table does not exist.
+    """
+    current = get(engine, db)
+    schema = current.tables.get(name)
+    if schema is None or any(c not in schema['types'] for c in columns):
+        if time.time() - current.loaded >= config.option('catalog', 'check_interval', 5):
+            log.debug("table [{}] or its columns not in catalog of [{}], reloading".format(name, db))
+            current = _reload(engine, db)
+    return current.table(name)
+
+
+def _reload(engine, db):
+    version = cache.catalog_version()
+    catalog = Catalog(db, _load(engine, db), version)
+    _catalogs[db] = catalog
+    return catalog
+
+
+def reload():
+    """Makes every worker reload its catalogs, e.g. after an ALTER TABLE."""
+    cache.bump_catalog_version()
+    _catalogs.clear()
@@ -1,8 +1,37 @@
+import os
 import yaml
 import logging
 
-with open('/etc/sdap/config.yml', 'r') as ymlfile:
-    CONF = yaml.load(ymlfile)
+DEFAULT_PATH = '/etc/sdap/config.yml'
+
+
+class _Config(object):
+    """The settings, read from $SDAP_CONFIG (default /etc/sdap/config.yml)
+    on first access rather than at import."""
+    def __init__(self):
+        self._settings = None
+
+    def _load(self):
+        if self._settings is None:
+            with open(os.environ.get('SDAP_CONFIG', DEFAULT_PATH), 'r') as ymlfile:
+                self._settings = yaml.safe_load(ymlfile)
+        return self._settings
+
+    def __getitem__(self, section):
+        return self._load()[section]
+
+    def __contains__(self, section):
+        return section in self._load()
+
+    def get(self, section, default=None):
+        return self._load().get(section, default)
+
+
+CONF = _Config()
+
+def option(section, name, default=None):
+    """Reads an optional setting, falling back to `default` if it is absent."""
+    return CONF.get(section, {}).get(name, default)
 
 def shared_db_name():
     return CONF['db']['shared_db']
@@ -22,3 +51,10 @@ def log_level():
 
 def use_cache():
     return CONF['redis']['enabled']
+
+def legacy_keys():
+    return option('auth', 'legacy_keys', True)
+
+def proxy_mode():
+    """Whether all apps share the service connection, with grants enforced by sdap."""
+    return option('db', 'mode', 'per_app') == 'proxy'
@@ -1,24 +1,56 @@
+import os
+
 from contextlib import contextmanager
 
-from sqlalchemy import create_engine, inspect
+from sqlalchemy import create_engine, event, exc, select
 from sqlalchemy.orm import sessionmaker, scoped_session
 from sqlalchemy.ext.declarative import declarative_base
+from sdap import catalog
 from sdap.config import CONF
 
 
 Base = declarative_base()
 
-_column_name_cache = {}
+
+def _ping_connection(connection, branch):
+    """Checks a connection when it is taken from the pool, replacing it if it went stale."""
+    if branch:
+        return
+    should_close_with_result = connection.should_close_with_result
+    connection.should_close_with_result = False
+    try:
+        connection.scalar(select([1]))
+    except exc.DBAPIError as err:
+        # the pool was invalidated along with the connection, retry once
+        if err.connection_invalidated:
+            connection.scalar(select([1]))
+        else:
+            raise
+    finally:
+        connection.should_close_with_result = should_close_with_result
 
 
 class DBEngine(object):
-    def __init__(self, user, password, db, host='127.0.0.1', port=3306, utf8=True):
+    def __init__(self, user, password, db, host='127.0.0.1', port=3306, utf8=True,
+                 pool_size=5, max_overflow=10, pool_timeout=30, pool_recycle=3600, pre_ping=False,
+                 connect_timeout=None):
         conn_str = 'mysql://{}:{}@{}:{}'.format(user, password, host, port)
         if db:
             conn_str = '/'.join([conn_str, db])
+        options = []
         if utf8:
-            conn_str = '?'.join([conn_str, "charset=utf8"])
-        self.engine = create_engine(conn_str, pool_recycle=3600)
+            options.append("charset=utf8")
+        if connect_timeout:
+            options.append("connect_timeout={}".format(connect_timeout))
+        if options:
+            conn_str = '?'.join([conn_str, '&'.join(options)])
+        self.db = db
+        self.host = host
+        self.port = port
+        self.engine = create_engine(conn_str, pool_size=pool_size, max_overflow=max_overflow,
+                                    pool_timeout=pool_timeout, pool_recycle=pool_recycle)
+        if pre_ping:
+            event.listen(self.engine, 'engine_connect', _ping_connection)
         self.session = scoped_session(sessionmaker(bind=self.engine))
 
 
@@ -39,23 +71,49 @@ class DBEngine(object):
         return self.engine.connect()
 
 
-    def columns(self, table):
-        """Get all column names of a table."""
-        if table in _column_name_cache:
-            return _column_name_cache[table]
-        else:
-            inspector = inspect(self.engine)
-            columns = inspector.get_columns(table)
-            column_names = [c['name'] for c in columns]
-            _column_name_cache[table] = column_names
-            return column_names
+    def columns(self, table, expected=()):
+        """Get all column names of a table.
+
+        The schema catalog is reloaded if the table or one of the `expected`
+        columns is not known yet, see `catalog.table`.
+        """
+        return self.schema(table, expected)['columns']
+
+    def schema(self, table, expected=()):
+        """Get the column names and types, primary key and indexes of a table.
+
+        See `catalog.Catalog` for the description format.
+        """
+        return catalog.table(LOCAL_CONN, self.db, table, expected)
 
     def tables(self, db):
         """Get all table names in a database."""
-        inspector = inspect(self.engine)
-        tables = inspector.get_table_names(db)
-        return tables
+        return sorted(catalog.get(LOCAL_CONN, db).tables)
+
+
+class _LocalEngine(object):
+    """The admin engine of the current process, created on first use.
+
+    A process forked after the engine was created creates its own, leaving
+    the pooled connections of its parent alone: closing them here would close
+    them for the parent too.
+    """
+    def __init__(self):
+        self._engine = None
+        self._pid = None
+        self._inherited = []
+
+    def get(self):
+        if self._pid != os.getpid():
+            if self._engine is not None:
+                self._inherited.append(self._engine)
+            cfg = CONF['db']
+            self._engine = DBEngine(cfg['admin_user'], cfg['admin_pass'], 'dapadmin', cfg['addr'], cfg['port'])
+            self._pid = os.getpid()
+        return self._engine
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
 
 
-_db_cfg = CONF['db']
-LOCAL_CONN = DBEngine(_db_cfg['admin_user'], _db_cfg['admin_pass'], 'dapadmin', _db_cfg['addr'], _db_cfg['port'])
+LOCAL_CONN = _LocalEngine()
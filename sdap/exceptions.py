@@ -39,3 +39,8 @@ class HTTPMissingParamError(DAPHTTPError):
     def __init__(self, msg):
         super(HTTPMissingParamError, self).__init__(falcon.HTTP_400, "Missing parameter: {}".format(msg))
 
+
+class HTTPNotFoundError(DAPHTTPError):
+    """Requested resource does not exist."""
+    def __init__(self, msg):
+        super(HTTPNotFoundError, self).__init__(falcon.HTTP_404, msg)
@@ -0,0 +1,226 @@
+import json
+import base64
+import logging
+
+from sdap import config, exceptions
+from sdap.lru import LRUCache
+
+
+log = logging.getLogger(__name__)
+
+# leaf operators: SQL template, given the quoted column and the placeholders
+OPERATORS = {
+    'eq': "{} = {}",
+    'ne': "{} <> {}",
+    'lt': "{} < {}",
+    'le': "{} <= {}",
+    'gt': "{} > {}",
+    'ge': "{} >= {}",
+    'in': "{} IN ({})",
+    'range': "{} BETWEEN {} AND {}",
+    'prefix': "{} LIKE {}",
+    'null': "{} IS NULL",
+    'not_null': "{} IS NOT NULL",
+}
+
+# operators which can be served by an index on their column
+_INDEXABLE = ('eq', 'lt', 'le', 'gt', 'ge', 'in', 'range', 'prefix', 'null')
+
+GUARD_OFF = 'off'
+GUARD_WARN = 'warn'
+GUARD_REJECT = 'reject'
+
+# compiled SQL by table and filter shape (the filter without its values),
+# along with the table description it was checked against; see `_plan_cache`
+_plans = None
+
+
+def _plan_cache():
+    """The cache of compiled filters, sized from the `filters` settings on first use."""
+    global _plans
+    if _plans is None:
+        _plans = LRUCache(config.option('filters', 'plan_cache_size', 1024), config.option('filters', 'plan_ttl', 60))
+    return _plans
+
+
+class Filter(object):
+    """A filter compiled to SQL.
+
+    Attributes:
+        sql(str):      condition with bound parameters `f0`, `f1`...
+        params(dict):  bound parameter values.
+        key(str):      normalized form of the filter, equal for equivalent filters.
+        columns(list): columns the filter reads.
+        indexed(bool): whether an index can narrow down the rows of every branch.
+    """
+    def __init__(self, sql, params, key, columns, indexed):
+        self.sql = sql
+        self.params = params
+        self.key = key
+        self.columns = columns
+        self.indexed = indexed
+
+
+def _canonical(node):
+    return json.dumps(node, sort_keys=True, separators=(',', ':'))
+
+
+def _invalid(msg):
+    return exceptions.HTTPBadRequestError("Invalid filter: {}".format(msg))
+
+
+def _scalar(value):
+    return value is None or not isinstance(value, (list, dict))
+
+
+def _normalize(node):
+    """Validates a filter and brings it into a canonical form.
+
+    A filter is a leaf `{"column": c, "op": o, "value": v}`, `{"and": [...]}`,
+    `{"or": [...]}`, or a list of filters which are and-ed. Conjunctions are
+    flattened and sorted, `in` values deduplicated and sorted. `eq` and `ne`
+    with a null value become `null` and `not_null`; other operators do not
+    take nulls, which SQL never matches.
+    """
+    if isinstance(node, list):
+        node = {'and': node}
+    if not isinstance(node, dict):
+        raise _invalid("filter must be an object or a list")
+    for conj in ('and', 'or'):
+        if conj in node:
+            if len(node) != 1 or not isinstance(node[conj], list) or not node[conj]:
+                raise _invalid("'{}' takes a non-empty list".format(conj))
+            children = []
+            for child in (_normalize(c) for c in node[conj]):
+                children.extend(child[conj] if conj in child else [child])
+            if len(children) == 1:
+                return children[0]
+            return {conj: sorted(children, key=_canonical)}
+
+    column, op, value = node.get('column'), node.get('op'), node.get('value')
+    if not isinstance(column, (type(''), type(u''))) or op not in OPERATORS:
+        raise _invalid("leaves need a column and one of {}".format(', '.join(sorted(OPERATORS))))
+    if value is None and op in ('eq', 'ne'):
+        op = 'null' if op == 'eq' else 'not_null'
+    if op == 'in':
+        if not isinstance(value, list) or not value or not all(_scalar(v) and v is not None for v in value):
+            raise _invalid("'in' takes a non-empty list of non-null values")
+        value = sorted(dict((_canonical(v), v) for v in value).items())
+        value = [v for _, v in value]
+    elif op == 'range':
+        if not isinstance(value, list) or len(value) != 2 or not all(_scalar(v) and v is not None for v in value):
+            raise _invalid("'range' takes [low, high]")
+    elif op == 'prefix':
+        if not isinstance(value, (type(''), type(u''))):
+            raise _invalid("'prefix' takes a string")
+    elif op in ('null', 'not_null'):
+        value = None
+    elif not _scalar(value) or value is None:
+        raise _invalid("'{}' takes a single non-null value".format(op))
+    return {'column': column, 'op': op, 'value': value}
+
+
+def _shape(node):
+    for conj in ('and', 'or'):
+        if conj in node:
+            return {conj: [_shape(c) for c in node[conj]]}
+    return [node['column'], node['op'], len(node['value']) if node['op'] == 'in' else None]
+
+
+def _values(node, values):
+    """Collects the bound values in placeholder order."""
+    for conj in ('and', 'or'):
+        if conj in node:
+            for child in node[conj]:
+                _values(child, values)
+            return values
+    op, value = node['op'], node['value']
+    if op in ('in', 'range'):
+        values.extend(value)
+    elif op == 'prefix':
+        values.append(value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%')
+    elif op not in ('null', 'not_null'):
+        values.append(value)
+    return values
+
+
+def _sql(node, known, counter, columns):
+    """Builds the SQL of a normalized filter; `counter` numbers the placeholders."""
+    for conj in ('and', 'or'):
+        if conj in node:
+            parts = [_sql(child, known, counter, columns) for child in node[conj]]
+            return "({})".format(" {} ".format(conj.upper()).join(parts))
+    column, op = node['column'], node['op']
+    if column not in known:
+        raise exceptions.HTTPBadRequestError("Invalid columns: {}".format(column))
+    columns.add(column)
+    if op == 'in':
+        arity = len(node['value'])
+    else:
+        arity = {'range': 2, 'null': 0, 'not_null': 0}.get(op, 1)
+    placeholders = [":f{}".format(counter[0] + i) for i in range(arity)]
+    counter[0] += arity
+    quoted = "`{}`".format(column)
+    if op == 'in':
+        return OPERATORS[op].format(quoted, ','.join(placeholders))
+    return OPERATORS[op].format(quoted, *placeholders)
+
+
+def _indexed(node, leading):
+    if 'and' in node:
+        return any(_indexed(c, leading) for c in node['and'])
+    if 'or' in node:
+        return all(_indexed(c, leading) for c in node['or'])
+    return node['op'] in _INDEXABLE and node['column'] in leading
+
+
+def _plan(table, node, schema):
+    """Compiles the SQL of a normalized filter, reusing the plan of an equally shaped filter.
+
+    Plans are only reused with the table description they were compiled
+    against; a reloaded catalog describes its tables anew, so columns or
+    indexes dropped since are never taken for granted.
+    """
+    shape = _canonical([table, _shape(node)])
+    plan = _plan_cache().get(shape)
+    if plan is None or plan[0] is not schema:
+        columns = set()
+        sql = _sql(node, schema['columns'], [0], columns)
+        leading = set(index['columns'][0] for index in schema['indexes'].values())
+        plan = (schema, sql, sorted(columns), _indexed(node, leading))
+        _plan_cache().set(shape, plan)
+    return plan[1:]
+
+
+def compile_filter(doc, table, schema):
+    """Compiles a filter on a table.
+
+    Depending on `filters.index_guard`, filters which no index can serve
+    are accepted (off), logged (warn) or refused (reject).
+
+    Args:
+        doc:          the filter, see `_normalize`.
+        table(str):   table name.
+        schema(dict): table description from the schema catalog.
+
+    Returns:
+        A `Filter`.
+    """
+    node = _normalize(doc)
+    sql, columns, indexed = _plan(table, node, schema)
+    params = dict(("f{}".format(n), v) for n, v in enumerate(_values(node, [])))
+    if not indexed:
+        guard = config.option('filters', 'index_guard', GUARD_WARN)
+        if guard == GUARD_REJECT:
+            raise exceptions.HTTPBadRequestError("Filter cannot use an index of table {}".format(table))
+        elif guard == GUARD_WARN:
+            log.warning("unindexed filter on table [{}]: {}".format(table, sql))
+    return Filter(sql, params, _canonical(node), columns, indexed)
+
+
+def decode(param):
+    """Decodes the `filter` query parameter: url-safe base64 encoded JSON."""
+    try:
+        return json.loads(base64.urlsafe_b64decode(str(param)).decode('utf-8'))
+    except (TypeError, ValueError, UnicodeDecodeError):
+        raise _invalid("not base64 encoded JSON")
@@ -0,0 +1,189 @@
+import json
+import base64
+import logging
+
+from decimal import Decimal
+from datetime import date, datetime, time, timedelta
+from sdap import config, exceptions
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+log = logging.getLogger(__name__)
+
+# response formats
+JSON = 'json'            # rows as objects
+COLUMNAR = 'columnar'    # column names once, rows as arrays
+MSGPACK = 'msgpack'      # columnar, MessagePack encoded
+NDJSON = 'ndjson'        # one row object (or array) per line, streamed only
+CSV = 'csv'              # header row then rows, uploads only
+
+MEDIA_TYPES = {
+    JSON: 'application/json',
+    COLUMNAR: 'application/vnd.sdap.columnar+json',
+    MSGPACK: 'application/x-msgpack',
+    NDJSON: 'application/x-ndjson',
+    CSV: 'text/csv',
+}
+
+BINARY = (MSGPACK,)
+
+
+def _timedelta(obj):
+    # MySQL TIME columns, which may be negative or exceed 24 hours
+    seconds = obj.days * 86400 + obj.seconds
+    sign = '-' if seconds < 0 else ''
+    if seconds < 0 and obj.microseconds:
+        seconds, micro = -seconds - 1, 1000000 - obj.microseconds
+    else:
+        seconds, micro = abs(seconds), obj.microseconds
+    text = "{}{:02d}:{:02d}:{:02d}".format(sign, seconds // 3600, seconds // 60 % 60, seconds % 60)
+    return "{}.{:06d}".format(text, micro) if micro else text
+
+def _serialize(obj):
+    """Encodes the column types json has no representation for."""
+    if isinstance(obj, (datetime, date, time)):
+        return obj.isoformat()
+    if isinstance(obj, Decimal):
+        # DECIMAL columns and SUM/AVG results, as strings: a float would
+        # round values beyond 15-17 significant digits
+        return str(obj)
+    if isinstance(obj, timedelta):
+        return _timedelta(obj)
+    if isinstance(obj, (bytes, bytearray)):
+        # BLOB and BINARY columns
+        return base64.b64encode(bytes(obj)).decode('ascii')
+    raise TypeError("Type {} not serializable".format(type(obj)))
+
+
+def _orjson_dumps(obj):
+    # orjson encodes datetime, date and time itself
+    return orjson.dumps(obj, default=_serialize).decode('utf-8')
+
+def _ujson_dumps(obj):
+    return ujson.dumps(obj, default=_serialize, ensure_ascii=False, escape_forward_slashes=False)
+
+def _json_dumps(obj):
+    return json.dumps(obj, default=_serialize, separators=(',', ':'))
+
+def _ujson_usable():
+    # ujson only takes a `default` callback since 5.x; older releases encode
+    # dates as timestamps, and current ones encode decimals as floats without
+    # calling `default`, so such releases are not used
+    try:
+        return ujson.loads(_ujson_dumps({'d': date(2000, 1, 1), 'n': Decimal('0.1')})) == {'d': '2000-01-01', 'n': '0.1'}
+    except TypeError:
+        return False
+
+ENCODERS = {
+    'orjson': (lambda: orjson is not None, _orjson_dumps),
+    'ujson': (lambda: ujson is not None and _ujson_usable(), _ujson_dumps),
+    'json': (lambda: True, _json_dumps),
+}
+
+def _select_encoder(name):
+    """Picks the JSON encoder configured as `json.encoder`.
+
+    `auto` takes the fastest one installed; a configured encoder which is not
+    installed falls back to `auto`.
+    """
+    if name != 'auto':
+        if name not in ENCODERS:
+            raise ValueError("Unknown json encoder: {}".format(name))
+        available, dumps = ENCODERS[name]
+        if available():
+            return name, dumps
+        log.warning("json encoder {} not available, picking another one".format(name))
+    for candidate in ('orjson', 'ujson', 'json'):
+        available, dumps = ENCODERS[candidate]
+        if available():
+            return candidate, dumps
+
+_encoder = None
+
+def encoder():
+    """Returns (name, dumps) of the JSON encoder, picked on first use."""
+    global _encoder
+    if _encoder is None:
+        _encoder = _select_encoder(config.option('json', 'encoder', 'auto'))
+    return _encoder
+
+def dumps(obj):
+    """Encodes an object as JSON with the configured encoder."""
+    return (_encoder or encoder())[1](obj)
+
+
+def encode(obj, fmt):
+    """Encodes a response object in a format.
+
+    Returns:
+        bytes for binary formats, str otherwise.
+    """
+    if fmt == MSGPACK:
+        return msgpack.packb(obj, default=_serialize, use_bin_type=True)
+    return dumps(obj)
+
+
+def negotiate(req):
+    """Picks the response format of a table or row read.
+
+    The `format` parameter takes precedence over the Accept header.
+    MessagePack falls back to JSON if the msgpack package is not installed.
+    """
+    fmt = req.get_param('format')
+    if fmt is None:
+        accept = req.accept or ''
+        for candidate in (MSGPACK, COLUMNAR):
+            if MEDIA_TYPES[candidate] in accept:
+                fmt = candidate
+                break
+        else:
+            fmt = JSON
+    if fmt not in (JSON, COLUMNAR, MSGPACK):
+        raise exceptions.HTTPBadRequestError("Invalid format: {}".format(fmt))
+    if fmt == MSGPACK and msgpack is None:
+        log.debug("msgpack not installed, falling back to json")
+        return JSON
+    return fmt
+
+
+def shape_rows(fmt, columns, rows):
+    """Shapes selected row tuples for a response format."""
+    if fmt == JSON:
+        return [dict(zip(columns, r)) for r in rows]
+    return {'columns': columns, 'rows': rows}
+
+
+def stream_format(req):
+    """Returns the format in which a table read should be streamed.
+
+    Newline-delimited JSON is streamed if the client accepts it, a regular JSON
+    document is streamed if `stream` is set. Otherwise returns None.
+    """
+    if MEDIA_TYPES[NDJSON] in (req.accept or ''):
+        return NDJSON
+    if req.get_param_as_bool('stream'):
+        return JSON
+    return None
+
+
+def upload_format(req):
+    """Returns the format of a streamed upload (NDJSON or CSV), or None for other bodies."""
+    content_type = req.content_type or ''
+    for fmt in (NDJSON, CSV):
+        if MEDIA_TYPES[fmt] in content_type:
+            return fmt
+    return None
@@ -1,3 +1,6 @@
+from sqlalchemy import inspect
+
+from sdap import cache
 from sdap.db import Base, LOCAL_CONN, DBEngine
 from sdap.utils import init_superuser
 from sdap.config import CONF
@@ -11,3 +14,18 @@ def init():
     # create tables
     Base.metadata.create_all(LOCAL_CONN.engine)
     init_superuser()
+
+
+def migrate():
+    """Upgrades the tables of an existing installation."""
+    inspector = inspect(LOCAL_CONN.engine)
+    columns = [c['name'] for c in inspector.get_columns('user')]
+    if 'key_id' not in columns:
+        # keys issued before this column existed keep working through
+        # the `auth.legacy_keys` fallback until they are reissued
+        conn = LOCAL_CONN.connect()
+        conn.execute("ALTER TABLE user ADD COLUMN key_id VARCHAR(12) NULL AFTER pswd, ADD UNIQUE INDEX key_id (key_id)")
+        conn.close()
+        print("user: added column key_id")
+    # cached bodies and schemas may predate the upgrade
+    cache.flush()
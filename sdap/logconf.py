@@ -1,26 +1,48 @@
 import logging
 from sdap import config
 
-conf_dict = {
-    'version': 1,
-    'disable_existing_loggers': False,
-    'formatters': {
-        'simple': {
-            'format': '%(asctime)s [%(levelname)s] %(name)s | %(message)s'
+
+def conf_dict():
+    """The logging configuration, for `logging.config.dictConfig`.
+
+    log.format: text or json (one object per line);
+    log.async: write records on a background thread instead of the request thread
+    """
+    formatter = 'json' if config.option('log', 'format', 'text') == 'json' else 'simple'
+
+    if config.option('log', 'async', True):
+        console = {
+            '()': 'sdap.logqueue.AsyncStreamHandler',
+            'queue_size': config.option('log', 'queue_size', 10000),
         }
-    },
-    'handlers': {
-        'console': {
+    else:
+        console = {
             'class': 'logging.StreamHandler',
-            'level': logging.DEBUG,
-            'formatter': 'simple',
-            'stream': 'ext://sys.stdout'
         }
-    },
-    'loggers': {
-        'sdap': {
-            'level': config.log_level(),
-            'handlers': ['console']
+    console.update({
+        'level': logging.DEBUG,
+        'formatter': formatter,
+        'stream': 'ext://sys.stdout'
+    })
+
+    return {
+        'version': 1,
+        'disable_existing_loggers': False,
+        'formatters': {
+            'simple': {
+                'format': '%(asctime)s [%(levelname)s] %(name)s | %(message)s'
+            },
+            'json': {
+                '()': 'sdap.logqueue.JSONFormatter'
+            }
+        },
+        'handlers': {
+            'console': console
+        },
+        'loggers': {
+            'sdap': {
+                'level': config.log_level(),
+                'handlers': ['console']
+            }
         }
     }
-}
@@ -0,0 +1,100 @@
+import os
+import json
+import atexit
+import logging
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+_STOP = None
+
+
+class AsyncStreamHandler(logging.StreamHandler):
+    """A StreamHandler which formats and writes records on a background thread.
+
+    Emitting only puts the record on a bounded queue, so request threads never
+    wait for the stream; records are dropped (and counted) while the queue is
+    full. The writer thread is started lazily in each process, since threads
+    do not survive the fork of uwsgi workers.
+    """
+    def __init__(self, stream=None, queue_size=10000):
+        logging.StreamHandler.__init__(self, stream)
+        self.queue_size = queue_size
+        self.dropped = 0
+        self._pid = None
+        self._queue = None
+        self._thread = None
+        self._start_lock = threading.Lock()
+
+    def _start(self):
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = queue.Queue(self.queue_size)
+            self._thread = threading.Thread(target=self._run, name='sdap-log')
+            self._thread.daemon = True
+            self._thread.start()
+            self._pid = os.getpid()
+        atexit.register(self.flush_queue)
+
+    def _run(self):
+        while True:
+            record = self._queue.get()
+            if record is _STOP:
+                break
+            logging.StreamHandler.emit(self, record)
+
+    def emit(self, record):
+        if self._pid != os.getpid():
+            self._start()
+        if record.exc_info:
+            # tracebacks reference live frames; render them now
+            record.exc_text = self.formatter.formatException(record.exc_info) if self.formatter else None
+            record.exc_info = None
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def flush_queue(self, timeout=2.0):
+        """Writes the records still queued, waiting at most `timeout` seconds."""
+        if self._pid != os.getpid() or not self._thread.is_alive():
+            return
+        try:
+            self._queue.put(_STOP, timeout=timeout)
+        except queue.Full:
+            return
+        self._thread.join(timeout)
+        self._pid = None
+
+    def close(self):
+        self.flush_queue()
+        logging.StreamHandler.close(self)
+
+
+class JSONFormatter(logging.Formatter):
+    """Formats records as one JSON object per line.
+
+    Fields passed with `extra` (e.g. the request id `rid`) are included.
+    """
+    _reserved = set(logging.LogRecord('', 0, '', 0, '', (), None).__dict__) | set(['message', 'asctime'])
+
+    def format(self, record):
+        doc = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for name, value in record.__dict__.items():
+            if name not in self._reserved:
+                doc[name] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            doc['exception'] = record.exc_text
+        return json.dumps(doc, default=str)
@@ -0,0 +1,271 @@
+import os
+import json
+import logging
+import threading
+
+from timeit import default_timer
+from contextlib import contextmanager
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from sdap import config, cache
+
+
+log = logging.getLogger(__name__)
+
+_DATA = 'metrics|data'
+_POOL = 'metrics|pool|'
+
+# table label of requests which failed or named a table that was not validated
+OTHER = 'other'
+# app label of unauthenticated requests
+ANONYMOUS = 'anonymous'
+
+# latency histogram buckets, in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# name: (type, help)
+METRICS = {
+    'sdap_requests_total': ('counter', 'Requests served, by route, method, status and table '
+                                       '(and app with metrics.per_app).'),
+    'sdap_request_duration_seconds': ('histogram', 'Request latency, by route and table (and app with metrics.per_app).'),
+    'sdap_phase_duration_seconds': ('histogram', 'Time spent per request in the auth, cache, db and '
+                                                 'serialization phases, by route and phase; '
+                                                 'auth includes its own DB lookups.'),
+    'sdap_response_bytes_total': ('counter', 'Response body bytes (streams excluded), by route and table '
+                                             '(and app with metrics.per_app).'),
+    'sdap_cache_requests_total': ('counter', 'Query cache lookups, by table and outcome.'),
+    'sdap_cache_hit_ratio': ('gauge', 'Query cache hit ratio over all tables.'),
+    'sdap_db_pool_connections': ('gauge', 'DB connections of the live workers, by app and state.'),
+    'sdap_db_pool_engines': ('gauge', 'Per-app engines held by the live workers.'),
+    'sdap_db_proxy_connections': ('gauge', 'DB connections of the live workers in proxy mode, by server and state.'),
+}
+
+_local = threading.local()
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _labels(**labels):
+    return ','.join('{}="{}"'.format(k, _escape(v)) for k, v in sorted(labels.items()) if v is not None)
+
+def _series(name, labels):
+    return '{}{{{}}}'.format(name, labels) if labels else name
+
+
+class Registry(object):
+    """Counters and histograms of one worker, flushed into redis where the
+    counters of all workers add up.
+
+    Series are kept in their exposition form, e.g. `name{label="value"}`.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = {}
+        self._sums = {}
+        self._flushed = default_timer()
+
+    def inc(self, name, labels, value=1):
+        series = _series(name, labels)
+        with self._lock:
+            self._counts[series] = self._counts.get(series, 0) + value
+
+    def observe(self, name, labels, seconds):
+        """Records an observation into the cumulative buckets of a histogram."""
+        sep = ',' if labels else ''
+        with self._lock:
+            for bound in BUCKETS:
+                # every bucket is written, so that all of them exist in redis
+                series = '{}_bucket{{{}{}le="{}"}}'.format(name, labels, sep, bound)
+                self._counts[series] = self._counts.get(series, 0) + (1 if seconds <= bound else 0)
+            for series, value in (('{}_bucket{{{}{}le="+Inf"}}'.format(name, labels, sep), 1),
+                                  (_series(name + '_count', labels), 1)):
+                self._counts[series] = self._counts.get(series, 0) + value
+            series = _series(name + '_sum', labels)
+            self._sums[series] = self._sums.get(series, 0.0) + seconds
+
+    def clear(self):
+        with self._lock:
+            self._counts = {}
+            self._sums = {}
+
+    def due(self):
+        return default_timer() - self._flushed >= config.option('metrics', 'flush_interval', 10)
+
+    def flush(self):
+        """Adds the worker's figures to the shared ones in redis."""
+        with self._lock:
+            counts, self._counts = self._counts, {}
+            sums, self._sums = self._sums, {}
+            self._flushed = default_timer()
+        conn = cache.connection()
+        try:
+            pipe = conn.pipeline(transaction=False)
+            for series, value in counts.items():
+                pipe.hincrby(_DATA, series, value)
+            for series, value in sums.items():
+                pipe.hincrbyfloat(_DATA, series, value)
+            _pool_snapshot(pipe)
+            pipe.execute()
+        except Exception as ex:
+            # metrics must never fail a request; the figures are lost
+            log.warning("metrics flush failed: %s", ex)
+
+
+REGISTRY = Registry()
+
+
+@contextmanager
+def phase(name):
+    """Times a phase of the current request."""
+    start = default_timer()
+    try:
+        yield
+    finally:
+        add_phase(name, default_timer() - start)
+
+def add_phase(name, seconds):
+    phases = getattr(_local, 'phases', None)
+    if phases is not None:
+        phases[name] = phases.get(name, 0.0) + seconds
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('sdap_started', []).append(default_timer())
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.get('sdap_started')
+    if started:
+        add_phase('db', default_timer() - started.pop())
+
+
+def _pool_snapshot(pipe):
+    # imported here: sdap.user imports the ORM models, which metrics need not load
+    from sdap.user import engine_pool, proxy_pool_stats
+    stats = engine_pool().stats()
+    stats['proxy'] = proxy_pool_stats()
+    ttl = max(3 * config.option('metrics', 'flush_interval', 10), 60)
+    pipe.set(_POOL + str(os.getpid()), json.dumps(stats), ex=ttl)
+
+
+class Metrics(object):
+    """Middleware recording request counts, latencies and response sizes.
+
+    Should come first in the middleware list, so that its timing covers the
+    other middlewares.
+    """
+    def process_request(self, req, resp):
+        req.context['_started'] = default_timer()
+        _local.phases = {}
+
+    def process_resource(self, req, resp, resource, params):
+        req.context['_route'] = type(resource).__name__
+        if 'table' in params:
+            # replaced by the table name once the handler has validated it,
+            # so that made-up names cannot create new series
+            req.context['_table'] = OTHER
+
+    def process_response(self, req, resp, resource, req_succeeded):
+        if '_started' not in req.context or not config.option('metrics', 'enabled', True):
+            return
+        elapsed = default_timer() - req.context['_started']
+        phases, _local.phases = getattr(_local, 'phases', None) or {}, None
+        route = req.context.get('_route', 'none')
+        status = resp.status.split()[0]
+        table = req.context.get('_table')
+        if table is not None and (not req_succeeded or int(status) >= 400):
+            table = OTHER
+        app = None
+        if config.option('metrics', 'per_app', False):
+            # one series per app and table: opt-in, as it multiplies the series
+            user = req.context.get('user')
+            app = user['app'] if user else ANONYMOUS
+        labels = _labels(route=route, app=app, table=table)
+
+        REGISTRY.inc('sdap_requests_total', _labels(route=route, method=req.method, status=status, app=app, table=table))
+        REGISTRY.observe('sdap_request_duration_seconds', labels, elapsed)
+        for name, seconds in phases.items():
+            REGISTRY.observe('sdap_phase_duration_seconds', _labels(route=route, phase=name), seconds)
+        body = resp.data if resp.data is not None else resp.body
+        if body is not None:
+            REGISTRY.inc('sdap_response_bytes_total', labels, len(body))
+        if REGISTRY.due():
+            REGISTRY.flush()
+
+
+def _order(line):
+    # histogram buckets by their bound rather than alphabetically
+    series, _, bound = line.partition('le="')
+    return series, float(bound.split('"')[0]) if bound else 0.0
+
+def _header(lines, name):
+    kind, text = METRICS[name]
+    lines.append('# HELP {} {}'.format(name, text))
+    lines.append('# TYPE {} {}'.format(name, kind))
+
+def exposition():
+    """Renders the metrics of all workers in the Prometheus text format."""
+    REGISTRY.flush()
+    conn = cache.connection()
+    data = conn.hgetall(_DATA)
+    by_name = {}
+    for series, value in data.items():
+        if isinstance(series, bytes):
+            series, value = series.decode('utf-8'), value.decode('utf-8')
+        name = series.split('{')[0]
+        for suffix in ('_bucket', '_count', '_sum'):
+            if name.endswith(suffix) and name[:-len(suffix)] in METRICS:
+                name = name[:-len(suffix)]
+        by_name.setdefault(name, []).append('{} {}'.format(series, value))
+
+    lines = []
+    for name in sorted(by_name):
+        if name in METRICS:
+            _header(lines, name)
+            lines.extend(sorted(by_name[name], key=_order))
+
+    stats = cache.stats()
+    _header(lines, 'sdap_cache_requests_total')
+    for table, outcomes in sorted(stats['tables'].items()):
+        for outcome, count in sorted(outcomes.items()):
+            lines.append('{} {}'.format(_series('sdap_cache_requests_total', _labels(table=table, outcome=outcome)),
+                                        count))
+    if stats['hit_ratio'] is not None:
+        _header(lines, 'sdap_cache_hit_ratio')
+        lines.append('sdap_cache_hit_ratio {}'.format(stats['hit_ratio']))
+
+    connections = {}
+    proxy = {}
+    engines = 0
+    for key in conn.scan_iter(_POOL + '*'):
+        snapshot = conn.get(key)
+        if snapshot is None:
+            continue
+        snapshot = json.loads(snapshot)
+        engines += snapshot['engines']
+        for app, pool in snapshot['apps'].items():
+            for state in ('checked_in', 'checked_out', 'overflow'):
+                series = _series('sdap_db_pool_connections', _labels(app=app, state=state))
+                connections[series] = connections.get(series, 0) + pool[state]
+        for server, pool in snapshot.get('proxy', {}).items():
+            for state in ('checked_in', 'checked_out', 'overflow'):
+                series = _series('sdap_db_proxy_connections', _labels(server=server, state=state))
+                proxy[series] = proxy.get(series, 0) + pool[state]
+    _header(lines, 'sdap_db_pool_engines')
+    lines.append('sdap_db_pool_engines {}'.format(engines))
+    if connections:
+        _header(lines, 'sdap_db_pool_connections')
+        lines.extend('{} {}'.format(series, value) for series, value in sorted(connections.items()))
+    if proxy:
+        _header(lines, 'sdap_db_proxy_connections')
+        lines.extend('{} {}'.format(series, value) for series, value in sorted(proxy.items()))
+    return '\n'.join(lines) + '\n'
+
+
+def reset():
+    """Drops the figures of all workers."""
+    REGISTRY.clear()
+    cache.connection().delete(_DATA)
@@ -0,0 +1,126 @@
+import time
+import logging
+import threading
+
+from collections import OrderedDict
+from sdap import config
+from sdap.db import DBEngine
+
+
+log = logging.getLogger(__name__)
+
+
+class EnginePool(object):
+    """Keeps the DB engines of apps within a bounded number of connections.
+
+    Every engine may hold up to `pool_size + max_overflow` connections
+    (overridable per app). When the engines of this worker could together exceed
+    `max_connections`, or an engine has been idle for `idle_timeout` seconds,
+    least recently used engines without checked out connections are disposed.
+    Their connections are closed, and the engine is recreated on next use.
+
+    All settings are read from `db.pool` in config.yml.
+    """
+    def __init__(self, conf=None):
+        conf = conf if conf is not None else config.option('db', 'pool', {})
+        self.max_connections = conf.get('max_connections', 100)
+        self.pool_size = conf.get('pool_size', 2)
+        self.max_overflow = conf.get('max_overflow', 3)
+        self.timeout = conf.get('timeout', 10)
+        self.recycle = conf.get('recycle', 3600)
+        self.idle_timeout = conf.get('idle_timeout', 600)
+        self.pre_ping = conf.get('pre_ping', True)
+        self.apps = conf.get('apps', {})
+        self.evictions = 0
+        self._engines = OrderedDict()  # key: (engine, app, capacity, last used)
+        self._lock = threading.Lock()
+
+    def _capacity(self, app):
+        app_conf = self.apps.get(app, {})
+        pool_size = app_conf.get('pool_size', self.pool_size)
+        max_overflow = app_conf.get('max_overflow', self.max_overflow)
+        return pool_size, max_overflow
+
+    def get(self, key, app, user, password, db, host, port):
+        """Gets the engine of an app, creating it if needed.
+
+        Args:
+            key:      identifies the engine, usually (DB user, host, port).
+            app(str): app name, used for per-app settings and statistics.
+            others:   see `DBEngine`.
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._engines.pop(key, None)
+            if entry is None:
+                pool_size, max_overflow = self._capacity(app)
+                engine = DBEngine(user, password, db, host, port, pool_size=pool_size, max_overflow=max_overflow,
+                                  pool_timeout=self.timeout, pool_recycle=self.recycle, pre_ping=self.pre_ping)
+                entry = [engine, app, pool_size + max_overflow, now]
+                log.debug("created engine for app [{}]".format(app))
+            entry[3] = now
+            self._engines[key] = entry
+            self._evict(now)
+            return entry[0]
+
+    def _evict(self, now):
+        total = sum(e[2] for e in self._engines.values())
+        for key, (engine, app, capacity, last_used) in list(self._engines.items())[:-1]:
+            idle = now - last_used > self.idle_timeout
+            if not idle and total <= self.max_connections:
+                break
+            if engine.engine.pool.checkedout():
+                continue
+            del self._engines[key]
+            engine.engine.dispose()
+            total -= capacity
+            self.evictions += 1
+            log.debug("disposed engine of app [{}]{}".format(app, " (idle)" if idle else ""))
+        if total > self.max_connections:
+            log.warning("app engines may open {} connections, over the limit of {}".format(total, self.max_connections))
+
+    def dispose(self):
+        """Disposes all engines."""
+        with self._lock:
+            for engine, _, _, _ in self._engines.values():
+                engine.engine.dispose()
+            self._engines.clear()
+
+    def connections(self, host, port):
+        """Returns the connections checked out from the server at `host`:`port`."""
+        with self._lock:
+            return sum(engine.engine.pool.checkedout() for engine, _, _, _ in self._engines.values()
+                       if engine.host == host and engine.port == port)
+
+    def stats(self):
+        """Returns the pool statistics of every engine, by app and then by server."""
+        now = time.time()
+        with self._lock:
+            apps = {}
+            engines = 0
+            for engine, app, capacity, last_used in self._engines.values():
+                pool = engine.engine.pool
+                server = {
+                    'capacity': capacity,
+                    'size': pool.size(),
+                    'checked_in': pool.checkedin(),
+                    'checked_out': pool.checkedout(),
+                    'overflow': pool.overflow(),
+                    'idle': round(now - last_used, 3),
+                }
+                totals = apps.get(app)
+                if totals is None:
+                    totals = apps[app] = {'capacity': 0, 'size': 0, 'checked_in': 0, 'checked_out': 0,
+                                          'overflow': 0, 'idle': server['idle'], 'servers': {}}
+                for name in ('capacity', 'size', 'checked_in', 'checked_out', 'overflow'):
+                    totals[name] += server[name]
+                totals['idle'] = min(totals['idle'], server['idle'])
+                totals['servers']['{}:{}'.format(engine.host, engine.port)] = server
+                engines += 1
+            return {
+                'engines': engines,
+                'capacity': sum(a['capacity'] for a in apps.values()),
+                'max_connections': self.max_connections,
+                'evictions': self.evictions,
+                'apps': apps,
+            }
@@ -0,0 +1,184 @@
+import os
+import glob
+import json
+import time
+import random
+import logging
+import pstats
+import cProfile
+import tempfile
+import threading
+
+from sdap import config, cache
+
+
+log = logging.getLogger(__name__)
+
+_CONFIG = 'profile|config'
+
+
+def _directory():
+    return config.option('profile', 'dir', '/tmp/sdap-profile')
+
+def _path(pid):
+    return os.path.join(_directory(), 'sdap-{}.pstats'.format(pid))
+
+
+def start(rate, route=None, app=None, duration=None):
+    """Turns sampling on in every worker.
+
+    Args:
+        rate(float):    fraction of requests to profile, 0 to 1.
+        route(str):     only profile requests whose path starts with it.
+        app(str):       only profile requests of this app.
+        duration(int):  seconds after which sampling stops by itself.
+    """
+    current = {'id': '%08x' % random.getrandbits(32), 'rate': rate, 'route': route, 'app': app}
+    clear()
+    cache.connection().set(_CONFIG, json.dumps(current), ex=duration)
+    return current
+
+def stop():
+    """Turns sampling off; the stats collected so far are kept."""
+    cache.connection().delete(_CONFIG)
+
+def settings():
+    stored = cache.connection().get(_CONFIG)
+    return json.loads(stored) if stored is not None else None
+
+def clear():
+    """Deletes the stats of all workers."""
+    for path in glob.glob(_path('*')):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def merged():
+    """Merges the stats of all workers.
+
+    Returns:
+        pstats.Stats, or None if nothing has been profiled.
+    """
+    current = settings()
+    SAMPLER.dump(current['id'] if current else None)
+    paths = glob.glob(_path('*'))
+    if not paths:
+        return None
+    stats = pstats.Stats(paths[0])
+    for path in paths[1:]:
+        try:
+            stats.add(path)
+        except (IOError, EOFError, ValueError):
+            # a worker was writing its file
+            log.warning("skipping unreadable profile %s", path)
+    return stats
+
+def dump_merged():
+    """Returns the merged stats in the pstats file format, or None."""
+    stats = merged()
+    if stats is None:
+        return None
+    fd, path = tempfile.mkstemp(suffix='.pstats')
+    os.close(fd)
+    try:
+        stats.dump_stats(path)
+        with open(path, 'rb') as f:
+            return f.read()
+    finally:
+        os.remove(path)
+
+
+class Sampler(object):
+    """Profiles a sample of the requests of one worker, accumulating their stats.
+
+    The settings are read from redis at most every `profile.check_interval`
+    seconds, so a disabled sampler costs a clock read per request.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._settings = None
+        self._checked = 0
+        self._stats = None
+        self._session = None
+        self._dumped = 0
+        self._pid = None
+
+    def _current(self):
+        now = time.time()
+        if now - self._checked >= config.option('profile', 'check_interval', 1):
+            self._checked = now
+            try:
+                self._settings = settings()
+            except Exception as ex:
+                log.warning("cannot read profiler settings: %s", ex)
+                self._settings = None
+        return self._settings
+
+    def sample(self, path):
+        """Returns the settings if a request to `path` should be profiled, else None."""
+        current = self._current()
+        if current is None or random.random() >= current['rate']:
+            return None
+        if current['route'] and not path.startswith(current['route']):
+            return None
+        return current
+
+    def add(self, session, profile):
+        """Accumulates the stats of a profiled request."""
+        with self._lock:
+            if session != self._session or self._pid != os.getpid():
+                self._session = session
+                self._pid = os.getpid()
+                self._stats = None
+            if self._stats is None:
+                self._stats = pstats.Stats(profile)
+            else:
+                self._stats.add(profile)
+        if time.time() - self._dumped >= config.option('profile', 'dump_interval', 5):
+            self.dump()
+
+    def dump(self, session=None):
+        """Writes the worker's stats to its file in `profile.dir`, unless they
+        belong to another sampling session than `session`."""
+        with self._lock:
+            if self._stats is None or self._pid != os.getpid():
+                return
+            if session is not None and session != self._session:
+                return
+            self._dumped = time.time()
+            directory = _directory()
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            # written aside and renamed, so readers never see a partial file
+            path = _path(self._pid)
+            self._stats.dump_stats(path + '.tmp')
+            os.rename(path + '.tmp', path)
+
+
+SAMPLER = Sampler()
+
+
+class Profiler(object):
+    """Middleware profiling the requests sampled by `SAMPLER`.
+
+    Should come early in the middleware list, so that the profile covers the
+    other middlewares.
+    """
+    def process_request(self, req, resp):
+        current = SAMPLER.sample(req.path)
+        if current is not None:
+            profile = cProfile.Profile()
+            req.context['_profile'] = (current, profile)
+            profile.enable()
+
+    def process_response(self, req, resp, resource, req_succeeded):
+        if '_profile' not in req.context:
+            return
+        current, profile = req.context.pop('_profile')
+        profile.disable()
+        user = req.context.get('user')
+        if current['app'] and (user is None or user['app'] != current['app']):
+            return
+        SAMPLER.add(current['id'], profile)
@@ -0,0 +1,145 @@
+import os
+import time
+import logging
+import threading
+import itertools
+
+from sdap import config, cache
+from sdap.db import DBEngine
+
+
+log = logging.getLogger(__name__)
+
+ROUND_ROBIN = 'round_robin'
+LEAST_CONNECTIONS = 'least_connections'
+
+_WRITTEN = 'written|{}'
+
+
+class Replica(object):
+    """A read replica and its last known replication lag."""
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.lag = None       # seconds behind the primary, None if unknown or broken
+        self.checked = 0
+        self.failures = 0     # checks failed in a row
+        self.next_check = 0
+        self._admin = None
+
+    def __repr__(self):
+        return "{}:{}".format(self.host, self.port)
+
+    def check(self):
+        """Reads the replication lag with the admin account."""
+        conf = config.CONF['db']
+        if self._admin is None:
+            self._admin = DBEngine(conf['admin_user'], conf['admin_pass'], None, self.host, self.port,
+                                   pool_size=1, max_overflow=0, pre_ping=True, connect_timeout=1)
+        self.checked = time.time()
+        try:
+            conn = self._admin.connect()
+            try:
+                status = conn.execute("SHOW SLAVE STATUS").fetchone()
+            finally:
+                conn.close()
+        except Exception as ex:
+            log.warning("replica {} unreachable: {}".format(self, ex))
+            self.lag = None
+            self.failures += 1
+            return
+        if status is None:
+            log.warning("replica {} is not replicating".format(self))
+            self.lag = None
+            self.failures += 1
+            return
+        # NULL while the replication threads are stopped
+        self.lag = status['Seconds_Behind_Master']
+        self.failures = 0 if self.lag is not None else self.failures + 1
+
+
+class ReplicaSet(object):
+    """Picks the replica serving a read.
+
+    Replicas are configured as `db.replicas` ([{addr, port}]) and picked
+    round-robin or by fewest connections checked out in this worker
+    (`db.replica_policy`). Replicas more than `db.max_lag` seconds behind, or
+    whose lag is unknown, are skipped.
+
+    The lag is read off the request path, by a background thread started
+    lazily in each worker (threads do not survive the fork of uwsgi workers),
+    every `db.lag_check_interval` seconds. A replica failing its checks is
+    checked less and less often, up to every `db.lag_check_backoff` seconds.
+    Until a worker's first check of a replica completes, its reads go to the
+    primary.
+    """
+    def __init__(self, conf=None):
+        conf = conf if conf is not None else config.CONF['db']
+        self.replicas = [Replica(r['addr'], r.get('port', 3306)) for r in conf.get('replicas') or []]
+        self.policy = conf.get('replica_policy', ROUND_ROBIN)
+        self.max_lag = conf.get('max_lag', 5)
+        self.check_interval = conf.get('lag_check_interval', 2)
+        self.max_backoff = max(conf.get('lag_check_backoff', 60), self.check_interval)
+        self._turn = itertools.count()
+        self._pid = None
+        self._start_lock = threading.Lock()
+
+    def _start(self):
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            thread = threading.Thread(target=self._run, name='sdap-replicas')
+            thread.daemon = True
+            thread.start()
+            self._pid = os.getpid()
+
+    def _run(self):
+        while True:
+            try:
+                self.check_due()
+            except Exception as ex:
+                log.exception(ex)
+            wait = min(r.next_check for r in self.replicas) - time.time()
+            time.sleep(min(max(wait, 0.1), self.check_interval))
+
+    def check_due(self):
+        """Checks the replicas whose check is due, backing off from those which fail."""
+        for replica in self.replicas:
+            if time.time() >= replica.next_check:
+                replica.check()
+                delay = self.check_interval * 2 ** min(replica.failures, 16)
+                replica.next_check = replica.checked + min(delay, self.max_backoff)
+
+    def _healthy(self):
+        return [r for r in self.replicas if r.lag is not None and r.lag <= self.max_lag]
+
+    def pick(self, connections=None):
+        """Returns a replica in sync enough to serve a read, or None.
+
+        Args:
+            connections: function giving the connections checked out from
+                         a replica (host, port), for least-connections.
+        """
+        if self.replicas and self._pid != os.getpid():
+            self._start()
+        healthy = self._healthy()
+        if not healthy:
+            return None
+        if self.policy == LEAST_CONNECTIONS and connections is not None:
+            return min(healthy, key=lambda r: connections(r.host, r.port))
+        return healthy[next(self._turn) % len(healthy)]
+
+
+def note_write(table):
+    """Sends the reads of a table to the primary for `db.read_your_writes`
+    seconds, until the replicas have caught up with a write.
+
+    This is per table rather than per app: a read served by a lagging replica
+    would otherwise be cached under the table's new generation for everyone.
+    """
+    seconds = config.option('db', 'read_your_writes', 5)
+    if seconds and config.option('db', 'replicas'):
+        cache.connection().set(_WRITTEN.format(table), 1, ex=seconds)
+
+def recently_written(table):
+    return cache.connection().exists(_WRITTEN.format(table))
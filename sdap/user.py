@@ -1,18 +1,26 @@
 import string
 import random
+import hashlib
 import logging
+import threading
 
 from passlib.hash import pbkdf2_sha256
 from sqlalchemy import Column, Integer, String, Boolean
 from sqlalchemy.orm import exc as orm_exc
 
-from sdap import exceptions
-from sdap.db import Base, DBEngine
+from sdap import exceptions, config, cache, acl
+from sdap.lru import LRUCache
+from sdap.pool import EnginePool
+from sdap.replicas import ReplicaSet
+from sdap.db import Base, DBEngine, LOCAL_CONN
 from sdap.config import CONF
 
 
 log = logging.getLogger(__name__)
 
+KEY_ID_LENGTH = 12
+KEY_SEPARATOR = '.'
+
 
 def generate_random_str(length=32):
     """Generates a random string of a specified length.
@@ -23,7 +31,65 @@ def generate_random_str(length=32):
     return ''.join(random.choice(chars) for _ in range(length))
 
 
-_user_cache = {}
+# set up on first use rather than at import, which must not need the config
+_setup_lock = threading.Lock()
+_auth_cache = None
+_privilege_cache = None
+_auth_generation = None
+
+
+def _local_caches():
+    """The in-process caches of authentications and of grants, sized from
+    the `auth` settings on first use."""
+    global _auth_cache, _privilege_cache
+    if _auth_cache is None:
+        with _setup_lock:
+            if _auth_cache is None:
+                size, ttl = config.option('auth', 'cache_size', 1024), config.option('auth', 'cache_ttl', 300)
+                _privilege_cache = LRUCache(size, ttl)
+                _auth_cache = LRUCache(size, ttl)
+    return _auth_cache, _privilege_cache
+
+
+def _key_digest(key):
+    """Digest of an api key, used instead of the key itself as cache key."""
+    if not isinstance(key, bytes):
+        key = key.encode('utf-8')
+    return hashlib.sha256(key).hexdigest()
+
+
+def _sync_auth_cache():
+    """Drops local authentications if any app's key was changed by another worker.
+
+    Returns:
+        The current authentication generation, see `cache.auth_generation`.
+    """
+    global _auth_generation
+    generation = cache.auth_generation()
+    if generation != _auth_generation:
+        for local in _local_caches():
+            local.clear()
+        _auth_generation = generation
+    return generation
+
+
+def _remember_auth(digest, info, generation):
+    """Caches an authentication result locally and for the other workers.
+
+    An empty `info` marks an invalid key, which is cached for a shorter time.
+    Nothing is cached if an app's key changed since `generation` was read,
+    before the key was looked up: the result may be that of a revoked key.
+    """
+    ttl = _auth_ttl(info)
+    if cache.set_auth(digest, info, ttl, generation):
+        _local_caches()[0].set(digest, info, ttl)
+
+
+def _auth_ttl(info):
+    if info:
+        return config.option('auth', 'cache_ttl', 300)
+    return config.option('auth', 'negative_ttl', 30)
+
 
 class User(Base):
     """ORM class of DB table `user`.
@@ -39,6 +105,7 @@ class User(Base):
     desc = Column(String(256), nullable=False)             # app description
     user = Column(String(32), nullable=False, unique=True) # generated DB user
     pswd = Column(String(32), nullable=False)              # generated DB password
+    key_id = Column(String(KEY_ID_LENGTH), nullable=True, unique=True) # non-secret API key prefix
     key = Column(String(87), nullable=True)                # hashed API key
     is_admin = Column(Boolean, nullable=False)             # flag of admin key (used by this service only)
 
@@ -66,12 +133,22 @@ class User(Base):
         Returns:
             A user dict if success, None otherwise.
         """
-        if key in _user_cache:
-            return _user_cache[key]
+        if not key:
+            return None
 
         try:
-            users = session.query(cls).all()
-            for user in users:
+            digest = _key_digest(key)
+            generation = _sync_auth_cache()
+            auth_cache = _local_caches()[0]
+            info = auth_cache.get(digest)
+            if info is None:
+                info = cache.cached_auth(digest)
+                if info is not None:
+                    auth_cache.set(digest, info, _auth_ttl(info))
+            if info is not None:
+                return info or None
+
+            for user in cls._auth_candidates(session, key):
                 if pbkdf2_sha256.verify(key, user.key):
                     # Cannot use user object outside the session scope,
                     # since the object has to be bound to a DB session.
@@ -83,16 +160,36 @@ class User(Base):
                         'pswd': user.pswd,
                         'is_admin': user.is_admin,
                     }
-                    _user_cache[key] = info
+                    _remember_auth(digest, info, generation)
                     return info
 
             else:
-                log.warning("Invalid key: {}".format(key))
+                # never log the key itself, only its non-secret id or a digest prefix
+                key_id, sep, _ = key.partition(KEY_SEPARATOR)
+                log.warning("Invalid key: {}".format(key_id[:KEY_ID_LENGTH] if sep else "sha256:" + digest[:12]))
+                _remember_auth(digest, {}, generation)
                 return None
         except Exception as ex:
             log.exception(ex)
             return None
 
+    @classmethod
+    def _auth_candidates(cls, session, key):
+        """Finds the users whose hashed key may match the api key.
+
+        Keys issued by `issue_key` carry a non-secret id prefix, which is looked up
+        through the unique index on `key_id`, so at most one hash is verified.
+        Keys issued before the prefix was introduced can only be found by checking
+        every user without a key id; this is controlled by `auth.legacy_keys`.
+        """
+        key_id, sep, _ = key.partition(KEY_SEPARATOR)
+        if sep:
+            user = session.query(cls).filter_by(key_id=key_id).first()
+            return [user] if user and user.key else []
+        if not config.legacy_keys():
+            return []
+        return session.query(cls).filter(cls.key_id == None, cls.key != None, cls.key != '').all()
+
     @classmethod
     def modify_user(cls, session, app, func):
         """Loads the user which match the app name, and
@@ -116,9 +213,14 @@ class User(Base):
         try:
             user = session.query(cls).filter_by(app=app).one()
             if func:
+                old_key = user.key
                 ret = func(user)
-                if not user.key:
-                    _user_cache.pop(user.key, None)
+                if user.key != old_key:
+                    # commit first so that no worker reads the old key again; the
+                    # ones already verifying it see the generation bumped by the
+                    # invalidation and do not cache their result (see `set_auth`)
+                    session.commit()
+                    cache.invalidate_auth(app)
                 return ret
         except orm_exc.NoResultFound:
             raise exceptions.HTTPBadRequestError("app not exist")
@@ -151,37 +253,153 @@ class User(Base):
 
         Will hash the key and save into DB for future authentication purpose.
 
+        The key has the form `<key id>.<secret>`. The key id is stored in plain text
+        so that authentication can locate the user without trying every hash.
+
         Returns:
             The original key (not hashed). The application should memorize this key.
         """
-        key = generate_random_str()
+        key_id = generate_random_str(KEY_ID_LENGTH)
+        key = KEY_SEPARATOR.join([key_id, generate_random_str()])
         hashed_key = pbkdf2_sha256.hash(key)
+        self.key_id = key_id
         self.key = hashed_key
         return key
 
+    def revoke_key(self):
+        """Revokes the api key of this app."""
+        self.key_id = None
+        self.key = ''
+
 
-_user_engines = {} # DB engine cache
+def _privileges(user):
+    """Loads (and caches) the grants held by the DB user of an app.
 
-def user_db_engine(user):
+    Cached along with the authentication, and refreshed when the app's privileges are changed.
+
+    Returns:
+        (fingerprint, privilege map); see `privilege_fingerprint` and `acl.parse_grants`.
+    """
+    dbuser = user['user']
+    privilege_cache = _local_caches()[1]
+    privileges = privilege_cache.get(dbuser)
+    if privileges is None:
+        with LOCAL_CONN.new_session() as session:
+            result = session.execute("SHOW GRANTS FOR '{}'@'%'".format(dbuser)).fetchall()
+        # drop the grantee (and its password hash), which differ between apps
+        grants = sorted(r[0].split(" TO ")[0] for r in result)
+        fingerprint = hashlib.sha1('\n'.join(grants).encode('utf-8')).hexdigest()[:16]
+        privileges = (fingerprint, acl.parse_grants(result, CONF['db']['shared_db']))
+        privilege_cache.set(dbuser, privileges)
+    return privileges
+
+
+def privilege_fingerprint(user):
+    """Digest of the grants held by the DB user of an app.
+
+    Apps with identical grants get the same fingerprint.
+
+    Args:
+        user(dict): user dict obtained from request context.
+    """
+    return _privileges(user)[0]
+
+
+def user_grants(user):
+    """Privilege map of the DB user of an app, see `acl.parse_grants`.
+
+    Args:
+        user(dict): user dict obtained from request context.
+    """
+    return _privileges(user)[1]
+
+
+_engines = None
+_replicas = None
+_proxy_engines = {}
+
+def engine_pool():
+    """The DB engine cache (`EnginePool`), set up from `db.pool` on first use."""
+    global _engines
+    if _engines is None:
+        with _setup_lock:
+            if _engines is None:
+                _engines = EnginePool()
+    return _engines
+
+def replica_set():
+    """The read replicas (`ReplicaSet`), set up from `db.replicas` on first use."""
+    global _replicas
+    if _replicas is None:
+        with _setup_lock:
+            if _replicas is None:
+                _replicas = ReplicaSet()
+    return _replicas
+
+def proxy_engine(host=None, port=None):
+    """The engine shared by all apps in proxy mode, connected as the service account
+    (`db.proxy.user`) to the primary or to the replica at `host`:`port`.
+
+    Raises:
+        HTTPServerError: if no service account is configured.
+    """
+    conf = CONF['db']
+    host, port = host or conf['addr'], port or conf['port']
+    engine = _proxy_engines.get((host, port))
+    if engine is None:
+        proxy = config.option('db', 'proxy', {})
+        if not proxy.get('user'):
+            # never fall back to the admin account, which may do anything anywhere
+            log.error("proxy mode needs a service account, set db.proxy.user and db.proxy.pass")
+            raise exceptions.HTTPServerError("Proxy mode is not configured")
+        engines = engine_pool()
+        engine = DBEngine(proxy['user'], proxy.get('pass', ''), conf['shared_db'], host, port,
+                          pool_size=proxy.get('pool_size', 10), max_overflow=proxy.get('max_overflow', 10),
+                          pool_timeout=engines.timeout, pool_recycle=engines.recycle, pre_ping=engines.pre_ping)
+        _proxy_engines[(host, port)] = engine
+    return engine
+
+def _proxy_connections(host, port):
+    engine = _proxy_engines.get((host, port))
+    return engine.engine.pool.checkedout() if engine is not None else 0
+
+def proxy_pool_stats():
+    """Returns the connection counts of the proxy mode engines, by server."""
+    stats = {}
+    for (host, port), engine in list(_proxy_engines.items()):
+        pool = engine.engine.pool
+        stats['{}:{}'.format(host, port)] = {
+            'checked_in': pool.checkedin(),
+            'checked_out': pool.checkedout(),
+            'overflow': pool.overflow(),
+        }
+    return stats
+
+def user_db_engine(user, read=False):
     """
     Get DB engine object from cache. Called in Login handler.
 
     Args:
         user(dict): user dict obtained from request context.
+        read(bool): whether the engine only serves reads, which may then go
+                    to a replica (see `ReplicaSet`).
 
     Returns:
         The DB engine associated to the user/app (which operates on behalf
-        of the DB user assigned to the app).
+        of the DB user assigned to the app). In proxy mode, the shared engine;
+        the caller must then check the app's grants with `user_grants`.
     """
-    dbuser = user['user']
     conf = CONF['db']
-    if dbuser not in _user_engines:
-        engine = DBEngine(dbuser, user['pswd'], conf['shared_db'], conf['addr'], conf['port'])
-        _user_engines[dbuser] = engine
-
-    return _user_engines[dbuser]
-
-
+    host, port = conf['addr'], conf['port']
+    engines = engine_pool()
+    if read and replica_set().replicas:
+        replica = replica_set().pick(_proxy_connections if config.proxy_mode() else engines.connections)
+        if replica is not None:
+            host, port = replica.host, replica.port
+    if config.proxy_mode():
+        return proxy_engine(host, port)
+    dbuser = user['user']
+    return engines.get((dbuser, host, port), user['app'], dbuser, user['pswd'], conf['shared_db'], host, port)
 
 if __name__ == '__main__':
     conn = DBEngine('dapadmin', '123456')
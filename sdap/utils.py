@@ -1,15 +1,14 @@
-import sys
+import os
 import json
 import logging
 import random
-import string
 import falcon
 import cProfile
 import pstats
 
-from datetime import date, datetime
+from timeit import default_timer
 from sqlalchemy import exc
-from sdap import exceptions, cache
+from sdap import config, exceptions, cache, formats, metrics
 from sdap.db import LOCAL_CONN
 from sdap.user import User
 
@@ -23,7 +22,7 @@ def do_cprofile(func):
         try:
             profile.enable()
             result = func(*args, **kwargs)
-            profile.disable
+            profile.disable()
             return result
         finally:
             #profile.dump_stats("profile.log")
@@ -41,6 +40,19 @@ def init_superuser():
         session.add(user)
 
 
+def init_worker():
+    """Opens the connections of a worker and loads the schema catalog, so
+    that its first request does not pay for them. Run after fork."""
+    started = default_timer()
+    try:
+        cache.connection().ping()
+        LOCAL_CONN.tables(config.shared_db_name())
+    except Exception as ex:
+        # the first request will try again
+        log.warning("worker warm-up failed: %s", ex)
+    log.info("worker %s initialized in %.3fs", os.getpid(), default_timer() - started)
+
+
 def create_db_user(user, pswd):
     """Creates a user in MySQL."""
     conn = LOCAL_CONN.connect()
@@ -49,18 +61,41 @@ def create_db_user(user, pswd):
     conn.close()
 
 
+def _loggable(body, sampled, limit):
+    """Renders a request/response body for the log: truncated to `limit`
+    characters, or only its size if the request is not sampled."""
+    if body is None:
+        return "<none>"
+    if not sampled:
+        return "<{} bytes>".format(len(body))
+    if len(body) > limit:
+        return "{} ...".format(body[:limit])
+    return body
+
+
 class Logger(object):
-    """Middleware class for request/response logging."""
+    """Middleware class for request/response logging.
+
+    Bodies are logged for a sample of requests (`log.body_sample`, 0 to 1)
+    and truncated to `log.body_max` characters; nothing is rendered unless
+    INFO is enabled.
+    """
     def process_request(self, req, resp):
         """Logs incoming requests.
 
         Args:
             see falcon documentation.
         """
-        rid = ''.join(random.choice(string.ascii_lowercase + string.digits) for _ in range(8)) # a random request id
+        rid = '%08x' % random.getrandbits(32) # a random request id
         req.context['_rid'] = rid
-        content = req.context['body']
-        log.info("**REQUEST**  [{}] from: [{}], route: {}, content: {}".format(rid, req.remote_addr, req.path, content))
+        if not log.isEnabledFor(logging.INFO):
+            return
+        sampled = random.random() < config.option('log', 'body_sample', 1.0)
+        req.context['_log_body'] = sampled
+        body = req.context['body']
+        content = "<stream>" if body is None else _loggable(body, sampled, config.option('log', 'body_max', 120))
+        log.info("**REQUEST**  [%s] from: [%s], route: %s, content: %s", rid, req.remote_addr, req.path, content,
+                 extra={'rid': rid})
 
     def process_response(self, req, resp, resource, req_succeeded):
         """Logs responses.
@@ -68,12 +103,16 @@ class Logger(object):
         Args:
             see falcon documentation.
         """
-        content = resp.body
-        if req_succeeded and len(content) > 120:
-            content = "{} ...".format(content[:120])
-
-        log.info("**RESPONSE** [{}] content: {}, succeeded: {}".format(
-            req.context['_rid'], content, req_succeeded))
+        if not log.isEnabledFor(logging.INFO):
+            return
+        if resp.stream is not None:
+            content = "<stream>"
+        elif resp.data is not None:
+            content = "<{} bytes>".format(len(resp.data))
+        else:
+            content = _loggable(resp.body, req.context.get('_log_body', True), config.option('log', 'body_max', 120))
+        rid = req.context.get('_rid')
+        log.info("**RESPONSE** [%s] content: %s, succeeded: %s", rid, content, req_succeeded, extra={'rid': rid})
 
 
 class RequireAuth(object):
@@ -96,7 +135,7 @@ class RequireAuth(object):
                 return
 
         key = req.auth
-        with LOCAL_CONN.new_session() as session:
+        with metrics.phase('auth'), LOCAL_CONN.new_session() as session:
             user = User.auth(session, key)
         if user:
             req.context['user'] = user
@@ -116,7 +155,7 @@ class AdminCheck(object):
         admin (list): suffixes of paths which require admin privilege.
     """
 
-    admin = ['register', 'privilege', 'key']
+    admin = ['register', 'privilege', 'key', 'cache', 'pool', 'catalog', 'metrics', 'profile']
 
     def process_resource(self, req, resp, resource, params):
         """Validates the token and insert the payload into the request.
@@ -139,8 +178,18 @@ class AdminCheck(object):
 
 
 class RequireJSON(object):
-    """Deny requests without 'Content-type:application/json' header."""
+    """Deny requests without 'Content-type:application/json' header.
+
+    Attributes:
+        uploads (list): roots of paths which also accept NDJSON or CSV uploads by POST.
+    """
+
+    uploads = ['data']
+
     def process_request(self, req, resp):
+        if req.method == 'POST' and formats.upload_format(req):
+            if any(_match_route(req.path, item) for item in RequireJSON.uploads):
+                return
         if req.method in ('POST', 'PUT'):
             if not req.content_type or 'application/json' not in req.content_type:
                 raise falcon.HTTPUnsupportedMediaType(
@@ -148,22 +197,24 @@ class RequireJSON(object):
 
 
 class StreamReader(object):
-    """Retrieve the request body from the stream."""
+    """Retrieve the request body from the stream.
+
+    Uploads (see `RequireJSON.uploads`) are left in the stream for the handler to consume.
+    """
     def process_request(self, req, resp):
+        if formats.upload_format(req):
+            req.context['body'] = None
+            return
         body = req.stream.read(req.content_length or 0)
         req.context['body'] = body
 
 
-def _dt_serialize(obj):
-    if isinstance(obj, (datetime, date)):
-        return obj.isoformat()
-    raise TypeError("Type {} not serializable".format(type(obj)))
-
 class JSONTranslator(object):
     """Serialize and Deserialize json in response and request.
 
     Deserialize json content and insert into req.context['doc'];
-    Serialize object in resp.context['result'] into the response.
+    Serialize object in resp.context['result'] into the response,
+    in the format negotiated by the handler (resp.context['format'], JSON by default).
     """
     #@do_cprofile
     def process_request(self, req, resp):
@@ -171,7 +222,7 @@ class JSONTranslator(object):
         # and allows you to read bytes from the request body.
         #
         # See also: PEP 3333
-        if req.content_length in (None, 0):
+        if req.content_length in (None, 0) or req.context['body'] is None:
             # Nothing to do
             return
 
@@ -194,19 +245,83 @@ class JSONTranslator(object):
         if 'result' not in resp.context:
             return
 
-        resp.body = json.dumps(resp.context['result'], default=_dt_serialize)
+        fmt = resp.context.get('format', formats.JSON)
+        with metrics.phase('serialization'):
+            _set_body(resp, formats.encode(resp.context['result'], fmt), fmt)
+
+
+def _set_body(resp, body, fmt):
+    if fmt in formats.BINARY:
+        resp.data = body
+    else:
+        resp.body = body
+    resp.content_type = formats.MEDIA_TYPES[fmt]
 
 
 class ResponseCache(object):
-    """Get the response body from cache if the handler marked a cache hit."""
+    """Hand the cached body to the response if the handler marked a cache hit,
+    or store the body if it marked a miss.
+
+    Bodies are cached already encoded; the format is part of the cache key.
+    Streamed responses are never cached.
+    """
     def process_response(self, req, resp, resource):
+        if 'stream' in resp.context:
+            return
+        fmt = resp.context.get('format', formats.JSON)
         if 'cache_hit' in resp.context:
-            resp.body = cache.cached_query(resp.context['cache_key'])
+            _set_body(resp, resp.context['cache_hit'], fmt)
             log.debug("cache hit, key: {}".format(resp.context['cache_key']))
         elif 'cache_miss' in resp.context:
-            # skip if the response is too large
-            if sys.getsizeof(resp.body) < 10 * 1024 * 1024:
-                cache.set_query(resp.context['cache_key'], resp.body)
+            body = resp.data if fmt in formats.BINARY else resp.body
+            # a failed request stores nothing but still releases the fill lock
+            with metrics.phase('cache'):
+                cache.set_query(resp.context['cache_key'], body if 'result' in resp.context else None,
+                                resp.context.get('cache_leader', True))
+
+
+def etags_match(req, tag):
+    """Whether the request's If-None-Match names the entity tag `tag`."""
+    header = req.if_none_match
+    if not header:
+        return False
+    if header.strip() == '*':
+        return True
+    for item in header.split(','):
+        item = item.strip()
+        if item.startswith('W/'):
+            item = item[2:]
+        if item == tag:
+            return True
+    return False
+
+
+class ConditionalGet(object):
+    """Answer conditional GETs with 304 Not Modified.
+
+    Entity tags are a digest of the response body. Handlers served from the
+    query cache take it from the cache, where it is stored along with the
+    body, and may mark the response not modified without reading the body
+    (see `sdap.api.mysql._from_cache`); other successful responses are
+    hashed here. Cache-Control is set from `http.cache_control`.
+    """
+    def process_response(self, req, resp, resource, req_succeeded):
+        if req.method != 'GET' or not req_succeeded or resp.stream is not None:
+            return
+        resp.cache_control = [config.option('http', 'cache_control', 'private, no-cache')]
+        if 'not_modified' not in resp.context:
+            if not resp.status.startswith('200'):
+                return
+            if resp.etag is None:
+                body = resp.data if resp.data is not None else resp.body
+                if body is None:
+                    return
+                resp.etag = cache.etag(body)
+            if not etags_match(req, resp.etag):
+                return
+        resp.status = falcon.HTTP_304
+        resp.body = None
+        resp.data = None
 
 
 def handle_db_exception(ex, req, resp, params):
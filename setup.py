@@ -9,12 +9,18 @@ setup(
     url = "https://github.com/solarsail/dap",
     description = "Shared data access platform",
     install_requires = ["falcon", "MySQL-python", "SQLAlchemy", "PyYAML", "passlib", "redis"],
+    extras_require = {
+        "msgpack": ["msgpack"],
+        # python 3 only; on python 2 the stdlib encoder is used
+        "orjson": ["orjson; python_version >= '3'"],
+        "ujson": ["ujson; python_version >= '3'"],
+    },
     data_files = [
         ("/etc/sdap", ["etc/uwsgi.ini", "etc/config.yml"]),
         ("/etc/nginx", ["etc/nginx.conf"]),
         ("/etc/systemd/system", ["etc/sdap.service"]),
     ],
     entry_points = {
-        "console_scripts": ["sdap_init = sdap.initialize:init"],
+        "console_scripts": ["sdap_init = sdap.initialize:init", "sdap_migrate = sdap.initialize:migrate"],
     }
 )
@@ -0,0 +1,19 @@
+import os
+
+import pytest
+
+# modules read the settings on first use; point them at the shipped config
+os.environ.setdefault('SDAP_CONFIG', os.path.join(os.path.dirname(__file__), '..', 'etc', 'config.yml'))
+
+from sdap import cache
+
+
+@pytest.fixture
+def redis(monkeypatch):
+    """Replaces redis by a fresh fakeredis server (lupa runs its Lua scripts)."""
+    import fakeredis
+    server = fakeredis.FakeServer()
+    monkeypatch.setattr(cache.redis, 'StrictRedis', lambda **kwargs: fakeredis.FakeStrictRedis(server=server))
+    monkeypatch.setattr(cache, '_client_pid', None)
+    yield cache.connection()
+    cache._client_pid = None
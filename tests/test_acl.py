@@ -0,0 +1,60 @@
+from sdap import acl
+
+
+def grants(*lines):
+    return acl.parse_grants([(line,) for line in lines], 'sdata')
+
+
+def test_parse_table_and_column_grants():
+    parsed = grants("GRANT SELECT, INSERT ON `sdata`.`orders` TO 'app_x'@'%'",
+                    "GRANT SELECT (`id`, `name`), UPDATE (`name`) ON `sdata`.`users` TO 'app_x'@'%'")
+    assert parsed == {
+        'orders': {'SELECT': None, 'INSERT': None},
+        'users': {'SELECT': set(['id', 'name']), 'UPDATE': set(['name'])},
+    }
+
+
+def test_parse_all_privileges_and_database_wide_grants():
+    parsed = grants("GRANT ALL PRIVILEGES ON `sdata`.`logs` TO 'app_x'@'%'",
+                    "GRANT SELECT ON `sdata`.* TO 'app_x'@'%'")
+    assert parsed['logs'] == dict((p, None) for p in acl.PRIVILEGES)
+    assert parsed['*'] == {'SELECT': None}
+
+
+def test_parse_ignores_other_databases():
+    assert grants("GRANT SELECT ON `other`.`orders` TO 'app_x'@'%'") == {}
+
+
+def test_parse_quoted_names():
+    parsed = grants("GRANT SELECT (`a,b`, `c`) ON `sdata`.`my``table` TO 'app_x'@'%'")
+    assert parsed == {'my`table': {'SELECT': set(['a,b', 'c'])}}
+
+
+def test_usage_grants_nothing():
+    parsed = grants("GRANT USAGE ON *.* TO 'app_x'@'%'")
+    assert not any(acl.allowed(parsed, 'orders', p) for p in acl.PRIVILEGES)
+
+
+def test_table_wide_grant_allows_any_columns():
+    parsed = grants("GRANT SELECT ON `sdata`.`orders` TO 'app_x'@'%'")
+    assert acl.allowed(parsed, 'orders', 'SELECT', ['id', 'total'])
+    assert acl.allowed(parsed, 'orders', 'SELECT')
+    assert not acl.allowed(parsed, 'orders', 'DELETE')
+    assert not acl.allowed(parsed, 'users', 'SELECT', ['id'])
+
+
+def test_column_grant_only_allows_its_columns():
+    parsed = grants("GRANT SELECT (`id`, `name`) ON `sdata`.`users` TO 'app_x'@'%'")
+    assert acl.allowed(parsed, 'users', 'SELECT', ['id'])
+    assert acl.allowed(parsed, 'users', 'SELECT', ['id', 'name'])
+    assert not acl.allowed(parsed, 'users', 'SELECT', ['id', 'password'])
+    # table-wide access, e.g. DELETE or all columns, needs a table-wide grant
+    assert not acl.allowed(parsed, 'users', 'SELECT')
+
+
+def test_database_wide_grant_applies_to_every_table():
+    parsed = grants("GRANT SELECT ON `sdata`.* TO 'app_x'@'%'",
+                    "GRANT UPDATE (`name`) ON `sdata`.`users` TO 'app_x'@'%'")
+    assert acl.allowed(parsed, 'anything', 'SELECT', ['a'])
+    assert acl.allowed(parsed, 'users', 'UPDATE', ['name'])
+    assert not acl.allowed(parsed, 'users', 'UPDATE', ['email'])
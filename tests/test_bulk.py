@@ -0,0 +1,118 @@
+import io
+from contextlib import contextmanager
+
+import pytest
+
+from sdap import bulk, exceptions, formats
+
+
+def lines(data, **kwargs):
+    return list(bulk._lines(io.BytesIO(data), len(data), **kwargs))
+
+
+def test_lines_across_blocks():
+    data = b'first\nsecond line\n\nlast'
+    assert lines(data, block=4) == [b'first\n', b'second line\n', b'last']
+
+
+def test_lines_keep_blank_lines_on_request():
+    assert lines(b'a\n\nb\n', blank=True) == [b'a\n', b'\n', b'b\n']
+
+
+def test_lines_stop_at_content_length():
+    stream = io.BytesIO(b'a\nb\ntrailing garbage')
+    assert list(bulk._lines(stream, 4)) == [b'a\n', b'b\n']
+
+
+def test_csv_rows():
+    columns, rows = bulk.read_rows(io.BytesIO(b'id,name,note\n1,ann,\n2,"bo, b",x\n'), formats.CSV)
+    assert columns == ['id', 'name', 'note']
+    assert list(rows) == [['1', 'ann', None], ['2', 'bo, b', 'x']]
+
+
+def test_csv_quoted_field_keeps_blank_lines():
+    data = b'id,note\n1,"one\n\nthree"\n\n2,x\n'
+    columns, rows = bulk.read_rows(io.BytesIO(data), formats.CSV, len(data))
+    assert list(rows) == [['1', 'one\n\nthree'], ['2', 'x']]
+
+
+def test_csv_columns_parameter_overrides_header():
+    columns, rows = bulk.read_rows(io.BytesIO(b'a,b\n1,2\n'), formats.CSV, columns=['x', 'y'])
+    assert columns == ['x', 'y']
+    assert list(rows) == [['1', '2']]
+
+
+def test_csv_malformed_line():
+    columns, rows = bulk.read_rows(io.BytesIO(b'id,name\n1,ann\n2,b\x00b\n'), formats.CSV)
+    rows = iter(rows)
+    assert next(rows) == ['1', 'ann']
+    with pytest.raises(bulk.ParseError):
+        next(rows)
+
+
+def test_ndjson_rows():
+    data = b'{"columns": ["id", "name"]}\n[1, "ann"]\n\n{"name": "bob", "id": 2}\n'
+    columns, rows = bulk.read_rows(io.BytesIO(data), formats.NDJSON, len(data))
+    assert columns == ['id', 'name']
+    assert list(rows) == [[1, 'ann'], [2, 'bob']]
+
+
+def test_ndjson_columns_from_first_object():
+    columns, rows = bulk.read_rows(io.BytesIO(b'{"b": 1, "a": 2}\n{"a": 3}\n'), formats.NDJSON)
+    assert columns == ['a', 'b']
+    assert list(rows) == [[2, 1], [3, None]]
+
+
+@pytest.mark.parametrize('line', [b'{"id": ', b'42'])
+def test_ndjson_malformed_line(line):
+    columns, rows = bulk.read_rows(io.BytesIO(b'{"id": 1}\n' + line + b'\n'), formats.NDJSON)
+    rows = iter(rows)
+    assert next(rows) == [1]
+    with pytest.raises(bulk.ParseError):
+        next(rows)
+
+
+class Engine(object):
+    """Records the rows inserted, as a DBEngine would insert them."""
+    def __init__(self):
+        self.inserted = []
+
+    @contextmanager
+    def new_session(self):
+        engine = self
+
+        class Result(object):
+            def __init__(self, count):
+                self.rowcount = count
+
+        class Connection(object):
+            def execute(self, statement, params):
+                engine.inserted.append(params)
+                return Result(len(params))
+
+        yield Connection()
+
+
+def test_insert_reports_parse_error_after_committed_chunks():
+    data = b'[1]\n[2]\n[3]\nnot json\n[5]\n'
+    columns, rows = bulk.read_rows(io.BytesIO(data), formats.NDJSON, columns=['id'])
+    engine = Engine()
+    count, chunks, failed = bulk.insert_rows(engine, 't', columns, rows, chunk_size=2)
+    assert count == 3
+    assert chunks == [{'offset': 0, 'rows': 2, 'count': 2}, {'offset': 2, 'rows': 1, 'count': 1}]
+    assert len(failed) == 1
+    assert (failed[0]['offset'], failed[0]['rows']) == (3, 1)
+    assert 'Malformed JSON line' in failed[0]['error']
+
+
+def test_atomic_insert_raises_parse_error():
+    columns, rows = bulk.read_rows(io.BytesIO(b'[1]\nnot json\n'), formats.NDJSON, columns=['id'])
+    with pytest.raises(bulk.ParseError):
+        bulk.insert_rows(Engine(), 't', columns, rows, chunk_size=10, atomic=True)
+
+
+@pytest.mark.parametrize('row', [1, 'ab', None, {'a': 1}])
+def test_insert_rejects_rows_which_are_not_lists(row):
+    with pytest.raises(exceptions.HTTPBadRequestError) as error:
+        bulk.insert_rows(Engine(), 't', ['a'], [[1], row], chunk_size=10, atomic=True)
+    assert error.value.message == "Row 1 is not a list of values"
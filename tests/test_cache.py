@@ -0,0 +1,97 @@
+import pytest
+
+from sdap import cache, config, formats
+from sdap.api import mysql
+
+
+QUERY = 'fingerprint|json|digest'
+
+
+def test_key_holds_table_namespace_and_generation(redis):
+    assert cache.fetch('t', QUERY) == ('q|t|0|0|' + QUERY, None, None, True)
+    cache.invalidate_table('t')
+    assert cache.fetch('t', QUERY)[0] == 'q|t|0|1|' + QUERY
+    cache.flush()
+    assert cache.fetch('t', QUERY)[0] == 'q|t|1|1|' + QUERY
+
+
+def test_etag_is_derived_from_the_body(redis):
+    key = cache.fetch('t', QUERY)[0]
+    cache.set_query(key, '{"result":"ok"}')
+    _, body, tag, _ = cache.fetch('t', QUERY)
+    assert body == b'{"result":"ok"}'
+    assert tag == cache.etag(body) == cache.etag(u'{"result":"ok"}')
+    assert cache.cached_etag('t', QUERY) == tag
+    assert cache.etag(b'{"result":"other"}') != tag
+
+
+def test_same_body_keeps_its_etag_across_generations(redis):
+    key = cache.fetch('t', QUERY)[0]
+    cache.set_query(key, '{"result":"ok"}')
+    tag = cache.cached_etag('t', QUERY)
+    cache.invalidate_table('t')
+    assert cache.cached_etag('t', QUERY) is None
+    key = cache.fetch('t', QUERY)[0]
+    cache.set_query(key, '{"result":"ok"}')
+    assert cache.cached_etag('t', QUERY) == tag
+
+
+def test_compressed_bodies(redis, monkeypatch):
+    monkeypatch.setitem(config.CONF['redis'], 'compress_min', 64)
+    body = ('{"data":[%s]}' % ','.join(['1'] * 100)).encode('ascii')
+    key = cache.fetch('t', QUERY)[0]
+    cache.set_query(key, body)
+    assert redis.get(key)[:1] == b'z'
+    assert cache.fetch('t', QUERY)[1:3] == (body, cache.etag(body))
+    assert cache.cached_etag('t', QUERY) == cache.etag(body)
+
+
+def test_failed_fill_releases_waiting_workers(redis):
+    key = cache.fetch('t', QUERY)[0]
+    assert redis.exists('lock|' + key)
+    cache.set_query(key, None)
+    assert not redis.exists('lock|' + key)
+    assert cache.fetch('t', QUERY)[1] is None
+
+
+def test_only_the_leader_releases_the_fill_lock(redis, monkeypatch):
+    monkeypatch.setitem(config.CONF['redis'], 'coalesce_wait', 50)
+    key, _, _, leader = cache.fetch('t', QUERY)
+    assert leader
+    # another worker waits until the lock expires and runs the query itself
+    assert cache.fetch('t', QUERY) == (key, None, None, False)
+    # meanwhile a third one takes a new lock
+    assert cache.fetch('t', QUERY)[3]
+    cache.set_query(key, None, leader=False)
+    assert redis.exists('lock|' + key)
+    # a result is still stored for the others
+    cache.set_query(key, '{"result":"ok"}', leader=False)
+    assert redis.exists('lock|' + key)
+    assert cache.fetch('t', QUERY)[1] == b'{"result":"ok"}'
+    cache.set_query(key, '{"result":"ok"}')
+    assert not redis.exists('lock|' + key)
+
+
+@pytest.fixture
+def fingerprint(monkeypatch):
+    monkeypatch.setattr(mysql, 'privilege_fingerprint', lambda user: user['grants'])
+
+
+def test_query_id_ignores_column_order_of_row_objects(fingerprint):
+    user = {'grants': 'g1'}
+    a = mysql._query_id(user, formats.JSON, columns=['b', 'a', 'a'], limit='10')
+    assert a == mysql._query_id(user, formats.JSON, columns=['a', 'b'], limit='10')
+    assert a.startswith('g1|json|')
+    # columnar responses list the columns in the requested order
+    assert (mysql._query_id(user, formats.COLUMNAR, columns=['b', 'a']) !=
+            mysql._query_id(user, formats.COLUMNAR, columns=['a', 'b']))
+
+
+def test_query_id_separates_grants_formats_and_parameters(fingerprint):
+    ids = set([
+        mysql._query_id({'grants': 'g1'}, formats.JSON, limit='10'),
+        mysql._query_id({'grants': 'g2'}, formats.JSON, limit='10'),
+        mysql._query_id({'grants': 'g1'}, formats.MSGPACK, limit='10'),
+        mysql._query_id({'grants': 'g1'}, formats.JSON, limit='20'),
+    ])
+    assert len(ids) == 4
@@ -0,0 +1,46 @@
+import pytest
+
+from sqlalchemy import exc
+
+from sdap import catalog, config
+
+
+def schema(*columns):
+    return {'columns': list(columns), 'types': dict((c, 'int') for c in columns), 'primary_key': [], 'indexes': {}}
+
+
+@pytest.fixture
+def loads(redis, monkeypatch):
+    """Serves the schemas in `loads[0]` and counts the catalog loads in `loads[1]`."""
+    state = [{'a': schema('id')}, 0]
+
+    def load(engine, db):
+        state[1] += 1
+        return dict(state[0])
+    monkeypatch.setattr(catalog, '_load', load)
+    monkeypatch.setattr(catalog, '_catalogs', {})
+    monkeypatch.setitem(config.CONF['catalog'], 'check_interval', 0)
+    return state
+
+
+def test_new_table_reloads_catalog(loads):
+    assert catalog.table(None, 'db', 'a')['columns'] == ['id']
+    loads[0]['b'] = schema('id')
+    assert catalog.table(None, 'db', 'b')['columns'] == ['id']
+    assert loads[1] == 2
+
+
+def test_new_column_reloads_catalog(loads):
+    catalog.table(None, 'db', 'a')
+    loads[0]['a'] = schema('id', 'name')
+    assert catalog.table(None, 'db', 'a', ['name'])['columns'] == ['id', 'name']
+    assert loads[1] == 2
+
+
+def test_missing_table_reloads_once_per_interval(loads, monkeypatch):
+    monkeypatch.setitem(config.CONF['catalog'], 'check_interval', 60)
+    catalog.table(None, 'db', 'a')
+    for _ in range(3):
+        with pytest.raises(exc.NoSuchTableError):
+            catalog.table(None, 'db', 'b')
+    assert loads[1] == 1
@@ -0,0 +1,108 @@
+import json
+import base64
+
+import pytest
+
+from sdap import config, exceptions, filters
+
+
+def schema(columns=('id', 'name', 'score', 'note'), indexes=(('PRIMARY', ['id']), ('score', ['score', 'name']))):
+    return {
+        'columns': list(columns),
+        'types': {},
+        'primary_key': ['id'],
+        'indexes': dict((name, {'unique': name == 'PRIMARY', 'columns': cols}) for name, cols in indexes),
+    }
+
+
+@pytest.fixture(autouse=True)
+def plans(monkeypatch):
+    # a fresh plan cache per test
+    monkeypatch.setattr(filters, '_plans', None)
+
+
+def compile(doc, table_schema=None):
+    return filters.compile_filter(doc, 't', table_schema or schema())
+
+
+def test_leaf():
+    flt = compile({'column': 'score', 'op': 'ge', 'value': 10})
+    assert flt.sql == "`score` >= :f0"
+    assert flt.params == {'f0': 10}
+    assert flt.columns == ['score']
+    assert flt.indexed
+
+
+def test_equivalent_filters_share_their_key():
+    a = compile([{'column': 'id', 'op': 'in', 'value': [3, 1, 3]},
+                 {'and': [{'column': 'score', 'op': 'lt', 'value': 5}]}])
+    b = compile({'and': [{'column': 'score', 'op': 'lt', 'value': 5},
+                         {'column': 'id', 'op': 'in', 'value': [1, 3]}]})
+    assert a.key == b.key
+    assert a.sql == b.sql
+    assert sorted(a.params.values()) == [1, 3, 5]
+
+
+def test_or_is_indexed_only_if_every_branch_is():
+    indexed = compile({'or': [{'column': 'id', 'op': 'eq', 'value': 1},
+                              {'column': 'score', 'op': 'range', 'value': [1, 9]}]})
+    assert indexed.indexed
+    assert indexed.sql.startswith('(') and ' OR ' in indexed.sql
+    # `name` only comes second in an index
+    assert not compile({'or': [{'column': 'id', 'op': 'eq', 'value': 1},
+                               {'column': 'name', 'op': 'eq', 'value': 'x'}]}).indexed
+
+
+def test_prefix_escapes_wildcards():
+    flt = compile({'column': 'name', 'op': 'prefix', 'value': '50%_off\\'})
+    assert flt.sql == "`name` LIKE :f0"
+    assert flt.params == {'f0': '50\\%\\_off\\\\%'}
+
+
+def test_eq_null_compiles_to_is_null():
+    assert compile({'column': 'note', 'op': 'eq', 'value': None}).sql == "`note` IS NULL"
+    assert compile({'column': 'note', 'op': 'ne', 'value': None}).sql == "`note` IS NOT NULL"
+    assert compile({'column': 'note', 'op': 'null'}).params == {}
+
+
+@pytest.mark.parametrize('leaf', [
+    {'column': 'score', 'op': 'lt', 'value': None},
+    {'column': 'score', 'op': 'in', 'value': [1, None]},
+    {'column': 'score', 'op': 'in', 'value': []},
+    {'column': 'score', 'op': 'range', 'value': [1]},
+    {'column': 'name', 'op': 'prefix', 'value': 1},
+    {'column': 'score', 'op': 'like', 'value': 1},
+    {'column': 'score', 'op': 'eq', 'value': [1]},
+    {'or': []},
+    'score = 1',
+])
+def test_invalid_filters(leaf):
+    with pytest.raises(exceptions.HTTPBadRequestError):
+        compile(leaf)
+
+
+def test_unknown_column():
+    with pytest.raises(exceptions.HTTPBadRequestError):
+        compile({'column': 'password', 'op': 'eq', 'value': 'x'})
+
+
+def test_plans_are_not_reused_with_a_reloaded_schema():
+    doc = {'column': 'note', 'op': 'eq', 'value': 'x'}
+    assert compile(doc, schema()).sql == "`note` = :f0"
+    reloaded = schema(columns=('id', 'name', 'score'))
+    with pytest.raises(exceptions.HTTPBadRequestError):
+        compile(doc, reloaded)
+
+
+def test_index_guard_rejects_unindexed_filters(monkeypatch):
+    monkeypatch.setitem(config.CONF['filters'], 'index_guard', filters.GUARD_REJECT)
+    with pytest.raises(exceptions.HTTPBadRequestError):
+        compile({'column': 'note', 'op': 'eq', 'value': 'x'})
+    assert compile({'column': 'id', 'op': 'eq', 'value': 1}).indexed
+
+
+def test_decode():
+    doc = [{'column': 'id', 'op': 'eq', 'value': 1}]
+    assert filters.decode(base64.urlsafe_b64encode(json.dumps(doc).encode('utf-8'))) == doc
+    with pytest.raises(exceptions.HTTPBadRequestError):
+        filters.decode('not base64!')
@@ -0,0 +1,76 @@
+import pytest
+
+from sdap import config, replicas
+
+
+@pytest.fixture
+def lags(monkeypatch):
+    """Replaces the lag check by a lookup of {host: lag}; a missing host is unreachable."""
+    lags = {}
+
+    def check(replica):
+        replica.checked = replicas.time.time()
+        replica.lag = lags.get(replica.host)
+        replica.failures = 0 if replica.lag is not None else replica.failures + 1
+    monkeypatch.setattr(replicas.Replica, 'check', check)
+    # no background thread: the tests run the checks themselves
+    monkeypatch.setattr(replicas.ReplicaSet, '_start', lambda self: None)
+    return lags
+
+
+def replica_set(*hosts, **conf):
+    conf['replicas'] = [{'addr': host} for host in hosts]
+    return replicas.ReplicaSet(conf)
+
+
+def test_no_replica_before_the_first_check(lags):
+    lags.update(a=0)
+    assert replica_set('a').pick() is None
+
+
+def test_round_robin_over_replicas_in_sync(lags):
+    lags.update(a=0, b=1, c=30)
+    rs = replica_set('a', 'b', 'c', 'd', max_lag=5)
+    rs.check_due()
+    assert sorted(repr(rs.pick()) for _ in range(4)) == ['a:3306', 'a:3306', 'b:3306', 'b:3306']
+
+
+def test_least_connections(lags):
+    lags.update(a=0, b=0)
+    rs = replica_set('a', 'b', replica_policy=replicas.LEAST_CONNECTIONS)
+    rs.check_due()
+    busy = {'a': 3, 'b': 1}
+    assert rs.pick(lambda host, port: busy[host]).host == 'b'
+
+
+def test_no_replica_in_sync(lags):
+    lags.update(a=10)
+    rs = replica_set('a', 'b', max_lag=5)
+    rs.check_due()
+    assert rs.pick() is None
+
+
+def test_failing_replicas_are_checked_less_often(lags, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(replicas.time, 'time', lambda: now[0])
+    rs = replica_set('down', lag_check_interval=2, lag_check_backoff=10)
+    delays = []
+    for _ in range(5):
+        now[0] = rs.replicas[0].next_check
+        rs.check_due()
+        delays.append(rs.replicas[0].next_check - now[0])
+    assert delays == [4, 8, 10, 10, 10]
+    lags['down'] = 0
+    now[0] = rs.replicas[0].next_check
+    rs.check_due()
+    assert rs.replicas[0].next_check - now[0] == 2
+    assert rs.pick().host == 'down'
+
+
+def test_recent_writes_keep_reads_on_the_primary(redis, monkeypatch):
+    monkeypatch.setitem(config.CONF['db'], 'replicas', [{'addr': 'a'}])
+    assert not replicas.recently_written('t')
+    replicas.note_write('t')
+    assert replicas.recently_written('t')
+    assert not replicas.recently_written('u')
+    assert 0 < redis.ttl('written|t') <= config.option('db', 'read_your_writes')
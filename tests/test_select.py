@@ -0,0 +1,57 @@
+from contextlib import contextmanager
+
+import pytest
+
+from sdap import config, exceptions
+from sdap.api import mysql
+
+
+class Engine(object):
+    """Serves the rows of one table with ids 1 to `rows`, whatever the statement."""
+    def __init__(self, rows=5):
+        self.rows = [(i, 'name {}'.format(i)) for i in range(1, rows + 1)]
+        self.executed = []
+
+    def columns(self, table, expected=()):
+        return ['id', 'name']
+
+    @contextmanager
+    def new_session(self):
+        engine = self
+
+        class Result(object):
+            def __init__(self, rows):
+                self.rows = rows
+
+            def fetchall(self):
+                return self.rows
+
+        class Connection(object):
+            def execute(self, statement, values):
+                engine.executed.append((str(statement), values))
+                return Result(engine.rows[:values.get('limit')])
+
+        yield Connection()
+
+
+@pytest.mark.parametrize('limit', ['0', '-3', 'ten', '1.5'])
+@pytest.mark.parametrize('start', [None, '1'])
+def test_invalid_limit(limit, start):
+    with pytest.raises(exceptions.HTTPBadRequestError):
+        mysql._select(Engine(), 't', start=start, limit=limit)
+
+
+def test_keyset_page():
+    columns, rows, _, cursor = mysql._select(Engine(), 't', limit='2', total='false')
+    assert rows == [(1, 'name 1'), (2, 'name 2')]
+    assert mysql._decode_cursor(cursor) == (2, 'asc')
+
+
+@pytest.mark.parametrize('start', [None, '1'])
+def test_limit_is_clamped(start, monkeypatch):
+    monkeypatch.setitem(config.CONF['db'], 'page_size_max', 3)
+    engine = Engine()
+    _, rows, _, _ = mysql._select(engine, 't', start=start, limit='100000000', total='false')
+    assert len(rows) == 3
+    # keyset pages read one extra row to tell whether there is a next page
+    assert engine.executed[0][1]['limit'] == (3 if start else 4)
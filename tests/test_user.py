@@ -0,0 +1,59 @@
+import pytest
+
+from sdap import cache, user
+from sdap.user import User
+
+
+KEY = 'abcdefghijkl.secret'
+
+
+class Query(object):
+    def __init__(self, found):
+        self.found = found
+
+    def filter_by(self, **kwargs):
+        return self
+
+    def first(self):
+        return self.found
+
+
+class Session(object):
+    """Finds the one app of the tests by its key id."""
+    def __init__(self, found):
+        self.found = found
+
+    def query(self, cls):
+        return Query(self.found)
+
+
+def hasher(verify):
+    return type('Hasher', (object,), {'verify': staticmethod(verify)})
+
+
+@pytest.fixture
+def app(redis, monkeypatch):
+    monkeypatch.setattr(user, '_auth_cache', None)
+    monkeypatch.setattr(user, '_privilege_cache', None)
+    monkeypatch.setattr(user, '_auth_generation', None)
+    return User(id=1, app='app1', desc='', user='app_x', pswd='p', key_id=KEY[:12], key='hash', is_admin=False)
+
+
+def test_auth_is_cached(app, monkeypatch):
+    monkeypatch.setattr(user, 'pbkdf2_sha256', hasher(lambda key, hashed: True))
+    assert User.auth(Session(app), KEY)['app'] == 'app1'
+    # served from the cache, the app being gone from the DB
+    assert User.auth(Session(None), KEY)['app'] == 'app1'
+    assert cache.cached_auth(user._key_digest(KEY))['app'] == 'app1'
+
+
+def test_key_revoked_during_auth_is_not_cached(app, monkeypatch):
+    def verify(key, hashed):
+        # another worker revokes the key while this one verifies it
+        cache.invalidate_auth('app1')
+        return True
+    monkeypatch.setattr(user, 'pbkdf2_sha256', hasher(verify))
+    assert User.auth(Session(app), KEY)['app'] == 'app1'
+    assert cache.cached_auth(user._key_digest(KEY)) is None
+    assert User.auth(Session(None), KEY) is None
+